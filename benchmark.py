@@ -0,0 +1,405 @@
+"""Benchmark offline del fichaje.
+
+Levanta en local un simulador de Bixpe (login con token antiforgery, página de
+jornada con botones y popup swal2) y una Bot API de Telegram falsa, apunta el
+bot a ellos y mide latencia extremo a extremo, desglose por pasos, pico de RSS
+y rendimiento con N cuentas en paralelo. No necesita red.
+
+Uso:
+    python benchmark.py --engine http --accounts 1,10,50
+    python benchmark.py --engine both --accounts 1,5 --latency-ms 50 --output resultados.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiohttp import web
+
+BENCH_PASSWORD = "bench-password"
+BENCH_TOKEN = "123456:BENCH"
+
+LOGIN_HTML = """<!DOCTYPE html>
+<html><head><title>Bixpe - Login</title></head><body>
+<form method="post" action="/Account/Login?ReturnUrl=%2Fapp">
+  <input type="hidden" name="__RequestVerificationToken" value="{token}">
+  <input id="Username" name="Username" type="text">
+  <input id="Password" name="Password" type="password">
+  <button type="submit">Entrar</button>
+</form>
+</body></html>"""
+
+WORKDAY_HTML = """<!DOCTYPE html>
+<html><head><title>Bixpe - Jornada</title></head><body>
+<input type="hidden" name="__RequestVerificationToken" value="{token}">
+<button id="btn-start-workday" data-url="/api/workday/start">Iniciar jornada</button>
+<button id="btn-stop-workday" data-url="/api/workday/stop">Finalizar jornada</button>
+<script>
+document.querySelectorAll("button[data-url]").forEach(function (button) {
+  button.addEventListener("click", function () {
+    var container = document.createElement("div");
+    container.className = "swal2-container";
+    container.innerHTML = '<div class="swal2-popup">' +
+      '<button class="swal2-confirm swal2-styled">Sí, continuar</button>' +
+      '<button class="swal2-cancel swal2-styled">Cancelar</button></div>';
+    document.body.appendChild(container);
+    container.querySelector(".swal2-cancel").addEventListener("click", function () { container.remove(); });
+    container.querySelector(".swal2-confirm").addEventListener("click", function () {
+      var token = document.querySelector("input[name=__RequestVerificationToken]").value;
+      fetch(button.dataset.url, {
+        method: "POST",
+        headers: {"RequestVerificationToken": token},
+        body: new URLSearchParams({"__RequestVerificationToken": token})
+      }).then(function () { container.remove(); });
+    });
+  });
+});
+</script>
+</body></html>"""
+
+
+class MockBixpe:
+    """Simulador local de auth2.bixpe.com y de la página de jornada"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sessions = {}  # cookie -> usuario
+        self.actions = []  # (usuario, acción)
+        self.logins = 0
+
+    async def _delay(self) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def login_page(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.Response(text=LOGIN_HTML.replace("{token}", "login-token"), content_type="text/html")
+
+    async def login_submit(self, request: web.Request) -> web.Response:
+        await self._delay()
+        form = await request.post()
+        if form.get("__RequestVerificationToken") != "login-token" or form.get("Password") != BENCH_PASSWORD:
+            return web.Response(text=LOGIN_HTML.replace("{token}", "login-token"), content_type="text/html")
+        self.logins += 1
+        session_id = f"s{len(self.sessions) + 1}"
+        self.sessions[session_id] = form.get("Username", "")
+        response = web.HTTPFound("/app")
+        response.set_cookie(".Bixpe.Auth", session_id, max_age=8 * 3600, httponly=True)
+        raise response
+
+    def _user(self, request: web.Request) -> str:
+        return self.sessions.get(request.cookies.get(".Bixpe.Auth", ""), "")
+
+    async def workday_page(self, request: web.Request) -> web.Response:
+        await self._delay()
+        user = self._user(request)
+        if not user:
+            raise web.HTTPFound("/Account/Login")
+        return web.Response(text=WORKDAY_HTML.replace("{token}", f"wd-{user}"), content_type="text/html")
+
+    async def workday_action(self, request: web.Request) -> web.Response:
+        await self._delay()
+        user = self._user(request)
+        if not user:
+            return web.json_response({"success": False, "message": "Sesión caducada"}, status=401)
+        if request.headers.get("RequestVerificationToken") != f"wd-{user}":
+            return web.json_response({"success": False, "message": "Token antiforgery inválido"}, status=400)
+        self.actions.append((user, request.match_info["action"]))
+        return web.json_response({"success": True})
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_get("/Account/Login", self.login_page)
+        app.router.add_post("/Account/Login", self.login_submit)
+        app.router.add_get("/app", self.workday_page)
+        app.router.add_post("/api/workday/{action}", self.workday_action)
+
+
+class FakeTelegram:
+    """Bot API de Telegram falsa: responde OK y cuenta peticiones y bytes"""
+
+    def __init__(self):
+        self.requests = {}
+        self.bytes_received = 0
+        self._message_id = 0
+
+    def _message(self, chat_id) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.requests[method] = self.requests.get(method, 0) + 1
+        self.bytes_received += request.content_length or 0
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = await request.post()
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendMediaGroup":
+            media = data.get("media", "[]")
+            count = len(json.loads(media) if isinstance(media, str) else media)
+            result = [self._message(data.get("chat_id")) for _ in range(count)]
+        elif method.startswith("send"):
+            result = self._message(data.get("chat_id"))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def routes(self, app: web.Application) -> None:
+        app.router.add_post("/bot{token}/{method}", self.handle)
+
+
+class RssSampler:
+    """Muestrea periódicamente la memoria del bot y de sus procesos hijos"""
+
+    def __init__(self, bot, interval: float = 0.1):
+        self.bot = bot
+        self.interval = interval
+        self.peak_self = 0
+        self.peak_children = 0
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self.peak_self = max(self.peak_self, self.bot._read_rss("self"))
+            self.peak_children = max(self.peak_children, await asyncio.to_thread(self.bot._child_processes_rss))
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+def _percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _step_deltas(bot, before: dict, name: str, label: str) -> dict:
+    """Media por paso (en segundos) de lo registrado durante un escenario"""
+    deltas = {}
+    for key, (count, total) in bot.metrics.histogram_totals(name, label).items():
+        prev_count, prev_total = before.get(key, (0, 0.0))
+        if count > prev_count:
+            deltas[key] = {
+                "count": count - prev_count,
+                "mean_seconds": round((total - prev_total) / (count - prev_count), 4),
+            }
+    return deltas
+
+
+async def run_scenario(bot, mock: MockBixpe, telegram: FakeTelegram, engine: str, n_accounts: int, action: str,
+                       two_phase: float = 0.0) -> dict:
+    """Ejecuta una acción para N cuentas y devuelve sus métricas
+
+    Con two_phase > 0 la hora de fichaje se fija esos segundos en el futuro y
+    se mide el error del clic respecto a ella.
+    """
+    bot.CLOCK_ENGINE = engine
+    accounts = [
+        bot.Account(name=f"bench{i:03d}", username=f"bench{i:03d}@example.com", password=BENCH_PASSWORD, chat_id=str(1000 + i))
+        for i in range(n_accounts)
+    ]
+    bot.roster = accounts
+    steps_before = bot.metrics.histogram_totals("bixpe_step_duration_seconds", "step")
+    waits_before = bot.metrics.histogram_totals("bixpe_wait_seconds", "wait")
+    telegram_before = dict(telegram.requests), telegram.bytes_received
+    logins_before = len(mock.actions), mock.logins
+
+    with RssSampler(bot) as sampler:
+        started = time.perf_counter()
+        results = await bot.run_for_accounts(action, accounts, time.time() + two_phase, two_phase=two_phase > 0)
+        wall = time.perf_counter() - started
+        flush_started = time.perf_counter()
+        delivered = await bot.outbox.flush(60)
+        flush = time.perf_counter() - flush_started
+
+    durations = [r.duration for r in results]
+    click_errors = [abs(r.click_error) for r in results if r.click_error is not None]
+    ok = [r for r in results if r.ok]
+    return {
+        "engine": engine,
+        "accounts": n_accounts,
+        "action": action,
+        "ok": len(ok),
+        "failed": len(results) - len(ok),
+        "errors": sorted({r.error for r in results if r.error}),
+        "engines_used": sorted({r.engine for r in results}),
+        "wall_seconds": round(wall, 4),
+        "throughput_accounts_per_second": round(n_accounts / wall, 3) if wall else None,
+        "latency_seconds": {
+            "mean": round(statistics.mean(durations), 4),
+            "p50": round(_percentile(durations, 50), 4),
+            "p95": round(_percentile(durations, 95), 4),
+            "max": round(max(durations), 4),
+        },
+        "click_error_seconds": {
+            "p50": round(_percentile(click_errors, 50), 4),
+            "max": round(max(click_errors), 4),
+        } if click_errors else None,
+        "steps": _step_deltas(bot, steps_before, "bixpe_step_duration_seconds", "step"),
+        "waits": _step_deltas(bot, waits_before, "bixpe_wait_seconds", "wait"),
+        "peak_rss_bytes": {"bot": sampler.peak_self, "browser": sampler.peak_children},
+        "server": {"actions": len(mock.actions) - logins_before[0], "logins": mock.logins - logins_before[1]},
+        "telegram": {
+            "requests": {k: v - telegram_before[0].get(k, 0) for k, v in telegram.requests.items() if v - telegram_before[0].get(k, 0)},
+            "bytes_uploaded": telegram.bytes_received - telegram_before[1],
+            "outbox_flush_seconds": round(flush, 4),
+            "delivered": delivered,
+        },
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+async def run_benchmark(args) -> dict:
+    mock, telegram = MockBixpe(args.latency_ms / 1000), FakeTelegram()
+    app = web.Application()
+    mock.routes(app)
+    telegram.routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    base = f"http://127.0.0.1:{args.port}"
+
+    # La configuración de main.py se lee al importarlo: apuntarla antes al simulador
+    data_dir = tempfile.mkdtemp(prefix="bixpe-bench-")
+    os.environ.update({
+        "BIXPE_LOGIN_URL": f"{base}/Account/Login",
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "TELEGRAM_CHAT_ID": "999",
+        "TELEGRAM_API_URL": f"{base}/bot",
+        "TELEGRAM_COALESCE_SECONDS": "0",
+        "TELEGRAM_CHAT_INTERVAL": "0",
+        "TELEGRAM_GLOBAL_RATE": "0",
+        "DATA_DIR": data_dir,
+        "HEADLESS": "true",
+        "SERVER_PORT": "0",
+        "BROWSER_PREWARM_MINUTES": "0",
+        "BROWSER_WORKER": "true" if args.browser_worker else "false",
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot
+    from telegram import Bot
+
+    bot.log_listener = bot.setup_logging()
+
+    bot.MAX_CONCURRENCY = args.concurrency
+    bot.STAGGER_SECONDS = args.stagger
+    bot.telegram_bot = Bot(BENCH_TOKEN, base_url=f"{base}/bot")
+    await bot.telegram_bot.initialize()
+    bot.outbox.start(bot.telegram_bot)
+
+    engines = ["http", "browser"] if args.engine == "both" else [args.engine]
+    scenarios = []
+    try:
+        for engine in engines:
+            for n_accounts in args.accounts:
+                # Primero en frío (sin sesión cacheada) y luego reutilizando la sesión
+                for cache_dir in os.listdir(data_dir):
+                    if cache_dir == "sessions":
+                        for name in os.listdir(os.path.join(data_dir, cache_dir)):
+                            os.remove(os.path.join(data_dir, cache_dir, name))
+                for action, session in (("start", "cold"), ("stop", "cached")):
+                    print(f"▶️ {engine} · {n_accounts} cuenta(s) · {action} ({session})...", file=sys.stderr)
+                    result = await run_scenario(bot, mock, telegram, engine, n_accounts, action, args.two_phase)
+                    result["session"] = session
+                    scenarios.append(result)
+                await bot.browser_manager.close()
+    finally:
+        await bot.outbox.stop(5)
+        await bot.browser_manager.close()
+        await bot.close_http_pool()
+        await bot.ledger.close()
+        await bot.telegram_bot.shutdown()
+        await runner.cleanup()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "engine": args.engine,
+            "accounts": args.accounts,
+            "concurrency": args.concurrency,
+            "stagger_seconds": args.stagger,
+            "latency_ms": args.latency_ms,
+            "two_phase_seconds": args.two_phase,
+            "browser_worker": args.browser_worker,
+        },
+        "max_rss_bytes": {
+            "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        },
+        "scenarios": scenarios,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del fichaje de Bixpe")
+    parser.add_argument("--engine", choices=("http", "browser", "both"), default="http", help="Motor de fichaje a medir")
+    parser.add_argument("--accounts", default="1,5", help="Lista de número de cuentas concurrentes, p. ej. 1,10,50")
+    parser.add_argument("--concurrency", type=int, default=4, help="MAX_CONCURRENCY durante la prueba")
+    parser.add_argument("--stagger", type=float, default=0.0, help="STAGGER_SECONDS durante la prueba")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latencia artificial del simulador por petición")
+    parser.add_argument("--two-phase", type=float, default=0.0,
+                        help="Fijar la hora de fichaje N segundos en el futuro y medir la precisión del clic")
+    parser.add_argument("--browser-worker", action="store_true",
+                        help="Ejecutar cada acción del navegador en un subproceso (BROWSER_WORKER)")
+    parser.add_argument("--port", type=int, default=18765, help="Puerto local del simulador")
+    parser.add_argument("--output", default="", help="Fichero JSON de resultados (por defecto bench_results/<fecha>.json)")
+    args = parser.parse_args(argv)
+    args.accounts = [int(n) for n in args.accounts.split(",") if n.strip()]
+    return args
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmark(args))
+
+    output = args.output or os.path.join("bench_results", f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    for s in results["scenarios"]:
+        print(
+            f"{s['engine']:>7} {s['accounts']:>4} cuentas {s['action']:>5} ({s['session']}): "
+            f"{s['ok']}/{s['accounts']} ok, p50 {s['latency_seconds']['p50'] * 1000:.0f} ms, "
+            f"p95 {s['latency_seconds']['p95'] * 1000:.0f} ms, {s['throughput_accounts_per_second']} cuentas/s, "
+            f"RSS bot {s['peak_rss_bytes']['bot'] // 2**20} MB / navegador {s['peak_rss_bytes']['browser'] // 2**20} MB"
+            + (f", error clic máx {s['click_error_seconds']['max'] * 1000:.0f} ms" if s["click_error_seconds"] else "")
+        )
+    print(f"📄 Resultados guardados en {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,356 +1,3174 @@
 import asyncio
+import atexit
+import base64
+import fnmatch
+import gzip
+import hashlib
+import hmac
+import html
+import io
+import json
 import os
-from datetime import datetime
-from playwright.async_api import async_playwright
-from telegram import Bot, Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+import queue
+import random
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+from telegram import Bot, InputMediaPhoto, Update
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, CommandHandler, ContextTypes, TypeHandler
 import logging
+import logging.handlers
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.base import STATE_PAUSED, STATE_STOPPED
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import pytz
 import signal
-import sys
 from concurrent.futures import ThreadPoolExecutor
 import aiohttp
+from aiohttp import web
+import yarl
+
+# Playwright y Pillow se importan al primer uso: el bot en reposo (y el motor HTTP) no los necesita
+async_playwright = None
+Image = None
+_pillow_checked = False
+
+
+class PlaywrightError(Exception):
+    """Sustituto de playwright.async_api.Error hasta que se importa Playwright (nunca se lanza)"""
+
+
+PlaywrightTimeoutError = PlaywrightError
+
+
+def load_playwright():
+    """Importa Playwright la primera vez que hace falta un navegador"""
+    global async_playwright, PlaywrightError, PlaywrightTimeoutError
+    if async_playwright is None:
+        from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+    return async_playwright
+
+
+def load_pillow():
+    """Importa Pillow la primera vez (opcional: reescalado y WebP de las capturas); None si no está"""
+    global Image, _pillow_checked
+    if not _pillow_checked:
+        _pillow_checked = True
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+    return Image
+
+# Directorio persistente (volumen /app/logs en Docker)
+DATA_DIR = os.getenv("DATA_DIR", "logs")
+
+# Configuración de logging: consola legible y fichero JSON rotado y comprimido en DATA_DIR
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # Nivel de la consola
+LOG_FILE = os.getenv("LOG_FILE", "bixpe.jsonl")  # Dentro de DATA_DIR; vacío = sin fichero
+LOG_FILE_LEVEL = os.getenv("LOG_FILE_LEVEL", "DEBUG").upper()  # DEBUG incluye la duración de cada paso
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")  # Rotación por tiempo (midnight, H...); vacío = por tamaño
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "7"))
+
+# Contexto del fichaje en curso (run_id, account, action, step) que se añade a cada registro
+_log_context = ContextVar("log_context", default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """Añade campos a los registros de log emitidos dentro del bloque (en la tarea actual)"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """Encola los registros con el contexto del fichaje; el formato y la E/S van en otro hilo"""
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Un objeto JSON por línea con los campos de contexto del fichaje"""
+
+    FIELDS = ("run_id", "account", "action", "step", "duration")
+
+    def format(self, record) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in self.FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    """Comprime el fichero rotado (se ejecuta en el hilo del QueueListener)"""
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging(pipe_handler: logging.Handler = None):
+    """Envía todos los logs a una cola; un QueueListener los escribe en consola y en el fichero JSON.
+
+    El loop solo encola (la cola no tiene límite), así que una ráfaga de logs
+    de muchas cuentas no retrasa ningún fichaje. Devuelve el listener. En el
+    subproceso del navegador (pipe_handler) los registros van directos al
+    padre, que es quien los escribe, y no hay listener.
+    """
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    if pipe_handler is not None:
+        root.handlers[:] = [pipe_handler]
+        return None
+
+    console = logging.StreamHandler()
+    console.setLevel(LOG_LEVEL)
+    console.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    handlers = [console]
+
+    if LOG_FILE:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        path = os.path.join(DATA_DIR, LOG_FILE)
+        if LOG_ROTATE_WHEN:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8"
+            )
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+            )
+        file_handler.namer = lambda name: f"{name}.gz"
+        file_handler.rotator = _gzip_rotator
+        file_handler.setLevel(LOG_FILE_LEVEL)
+        file_handler.setFormatter(JsonLogFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    root.handlers[:] = [_ContextQueueHandler(log_queue)]
+    # Los registros DEBUG del bot (duración de pasos) solo van al fichero; las librerías siguen en INFO
+    logger.setLevel(min(handler.level for handler in handlers))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+logger = logging.getLogger(__name__)
+log_listener = None  # Lo arranca main() con setup_logging(); importar el módulo no toca los logs
+
+# Configuración desde variables de entorno
+LOGIN_URL = os.getenv("BIXPE_LOGIN_URL", "https://auth2.bixpe.com/Account/Login")
+USERNAME = os.getenv("BIXPE_USERNAME", "tu_usuario")
+PASSWORD = os.getenv("BIXPE_PASSWORD", "tu_contraseña")
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")  # Base de la Bot API
+# Webhook de Telegram: URL pública (https://.../telegram) que llega a SERVER_PORT; vacío = long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "") or hashlib.sha256(
+    f"webhook:{TELEGRAM_TOKEN}".encode("utf-8")
+).hexdigest()
+BUTTON_SELECTOR = os.getenv("BUTTON_SELECTOR", "button[type='submit']")  # Ajusta según la web
+HEADLESS = os.getenv("HEADLESS", "false").lower() == "true"
+TIMEZONE = pytz.timezone('Europe/Madrid')
+
+# Caché de sesión autenticada (storage_state de Playwright)
+SESSION_CACHE = os.getenv("SESSION_CACHE", "true").lower() == "true"
+SESSION_DIR = os.getenv("SESSION_DIR", os.path.join(DATA_DIR, "sessions"))
+
+# Motor de fichaje: "browser" (Playwright) o "http" (aiohttp, con Playwright como respaldo)
+CLOCK_ENGINE = os.getenv("CLOCK_ENGINE", "browser").lower()
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+BIXPE_WORKDAY_URL = os.getenv("BIXPE_WORKDAY_URL", "")  # Página con los botones de jornada
+BIXPE_START_URL = os.getenv("BIXPE_START_URL", "")  # Endpoint de inicio (si no, se lee del botón)
+BIXPE_STOP_URL = os.getenv("BIXPE_STOP_URL", "")  # Endpoint de fin (si no, se lee del botón)
+
+# Capturas de pantalla (en memoria, sin pasar por disco)
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "jpeg").lower()  # jpeg, png o webp (webp requiere Pillow)
+SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "70"))  # Calidad JPEG/WebP (1-100)
+SCREENSHOT_MAX_WIDTH = int(os.getenv("SCREENSHOT_MAX_WIDTH", "1280"))  # Reescalar si es más ancha (requiere Pillow). 0 = no
+SCREENSHOT_SELECTOR = os.getenv("SCREENSHOT_SELECTOR", "")  # Recortar a este elemento (vacío = viewport completo)
+
+# Política de recursos del navegador (bloqueo de peticiones innecesarias)
+BLOCK_RESOURCE_TYPES = {t.strip() for t in os.getenv("BLOCK_RESOURCE_TYPES", "image,media,font").split(",") if t.strip()}
+BLOCK_URL_PATTERNS = [p.strip() for p in os.getenv(
+    "BLOCK_URL_PATTERNS",
+    "*google-analytics.com*,*googletagmanager.com*,*doubleclick.net*,*facebook.net*,*hotjar.com*,*clarity.ms*"
+).split(",") if p.strip()]
+ALLOW_URL_PATTERNS = [p.strip() for p in os.getenv("ALLOW_URL_PATTERNS", "").split(",") if p.strip()]  # Nunca se bloquean
+ASSET_CACHE = os.getenv("ASSET_CACHE", "true").lower() == "true"  # Caché en disco de CSS/JS entre ejecuciones
+ASSET_CACHE_TTL = int(os.getenv("ASSET_CACHE_TTL", "86400"))  # Segundos de validez de un recurso cacheado
+
+# Servidor HTTP interno (/metrics). 0 = desactivado
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+
+# Vigilancia del loop y /healthz
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "5"))  # Segundos entre mediciones del retraso del loop
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "2"))  # Retraso (s) a partir del cual se vuelcan las pilas
+LOOP_STALL_EXIT = float(os.getenv("LOOP_STALL_EXIT", "300"))  # Loop bloqueado N s = salir para que Docker reinicie; 0 = nunca
+SCHEDULER_TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "60"))  # Latido del scheduler
+TELEGRAM_PROBE_INTERVAL = float(os.getenv("TELEGRAM_PROBE_INTERVAL", "3600"))  # getMe solo tras tanto tiempo sin tráfico con Telegram
+
+# Modo multicuenta
+ACTIONS_FILE = os.getenv("ACTIONS_FILE", "")  # JSON con acciones de jornada adicionales
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "")  # JSON con la lista de cuentas (vacío = cuenta única por env)
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))  # Cuentas fichando a la vez
+STAGGER_SECONDS = float(os.getenv("STAGGER_SECONDS", "2"))  # Separación entre arranques de cuentas
+
+# Programación en dos fases: preparar (login, página lista) antes de la hora y pulsar a la hora exacta
+TWO_PHASE_SCHEDULING = os.getenv("TWO_PHASE_SCHEDULING", "true").lower() == "true"
+PRECLICK_MIN_LEAD = float(os.getenv("PRECLICK_MIN_LEAD", "20"))  # Segundos mínimos de preparación antes de la hora
+PRECLICK_MAX_LEAD = float(os.getenv("PRECLICK_MAX_LEAD", "180"))  # Máximo; el job se dispara con esta antelación
+CLICK_JITTER_SECONDS = float(os.getenv("CLICK_JITTER_SECONDS", "0"))  # Desfase aleatorio [0, N] s tras la hora
+
+# Límites de cada job: presupuesto desde la hora programada y espera máxima al cerrar
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "300"))
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "60"))
+
+# Registro de fichajes (SQLite) y recuperación de los perdidos al arrancar
+LEDGER_PATH = os.getenv("LEDGER_PATH", os.path.join(DATA_DIR, "ledger.sqlite3"))
+CATCHUP_ON_START = os.getenv("CATCHUP_ON_START", "true").lower() == "true"
+
+# Calendario laboral: festivos (ICS o texto, separados por comas) y vacaciones gestionadas con /vacation
+HOLIDAYS_FILES = [p.strip() for p in os.getenv("HOLIDAYS_FILES", "").split(",") if p.strip()]
+VACATIONS_FILE = os.getenv("VACATIONS_FILE", os.path.join(DATA_DIR, "vacations.json"))
+
+# Timeouts (ms) de cada espera del navegador, configurables con TIMEOUT_<NOMBRE>_MS
+WAIT_TIMEOUTS = {
+    name: int(os.getenv(f"TIMEOUT_{name.upper()}_MS", str(default)))
+    for name, default in (
+        ("login_page", 15000),     # Formulario de login visible
+        ("post_login", 20000),     # Salida de la página de login tras enviar credenciales
+        ("workday_ready", 15000),  # Botón de jornada visible y habilitado
+        ("popup_open", 5000),      # Popup swal2 de confirmación abierto
+        ("server_response", 10000),  # Respuesta del servidor a start/stop
+        ("popup_close", 5000),     # Popup swal2 cerrado
+    )
+}
+
+# Configuración del pool de conexiones
+TELEGRAM_POOL_SIZE = 5
+TELEGRAM_POOL_TIMEOUT = 10
+
+# Cola de salida de Telegram
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))  # Segundos entre envíos al mismo chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # Envíos/s en total (Telegram admite ~30)
+TELEGRAM_COALESCE_SECONDS = float(os.getenv("TELEGRAM_COALESCE_SECONDS", "2"))  # Ventana para agrupar ráfagas
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", "8"))  # Intentos antes de descartar un envío
+
+# Configuración del navegador reutilizable
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "20"))  # Reciclar tras N contextos
+BROWSER_IDLE_TIMEOUT = int(os.getenv("BROWSER_IDLE_TIMEOUT", "900"))  # Segundos sin uso antes de cerrarlo
+BROWSER_PREWARM_MINUTES = int(os.getenv("BROWSER_PREWARM_MINUTES", "2"))  # 0 = sin precalentamiento
+BROWSER_WORKER = os.getenv("BROWSER_WORKER", "false").lower() == "true"  # Cada acción en un subproceso efímero
+BROWSER_WORKER_PIPE_LIMIT = 32 * 1024 * 1024  # Línea máxima del subproceso (una captura en base64)
+
+# Instancia del bot de Telegram (se inicializa en main usando la Application)
+telegram_bot = None
+
+# Scheduler global (AsyncIOScheduler en lugar de BackgroundScheduler)
+scheduler = None
+
+# Fichajes en curso: tarea del job -> (acción, nombres de cuenta)
+inflight = {}
+
+# Se activa con SIGINT/SIGTERM para cerrar esperando a los fichajes en curso
+shutdown_event = asyncio.Event()
+
+# Estado del bot
+bot_state = {
+    "running": True,
+    "app": None
+}
+
+
+@dataclass
+class Account:
+    """Cuenta de Bixpe con su horario y su chat de Telegram"""
+    name: str
+    username: str
+    password: str
+    chat_id: str = ""
+    morning: str = "09:00"
+    afternoon: str = "18:00"
+    days: str = "mon-fri"
+    schedule: dict = field(default_factory=dict)  # Horas de las acciones adicionales, p. ej. {"pause": "14:00"}
+    holidays: list = field(default_factory=list)  # Ficheros de festivos propios (además de HOLIDAYS_FILES)
+
+
+@dataclass
+class RunResult:
+    """Resultado de una acción de fichaje sobre una cuenta"""
+    account: str
+    action: str
+    ok: bool = False
+    engine: str = ""
+    error: str = ""
+    duration: float = 0.0
+    waits: dict = field(default_factory=dict)  # Segundos de cada espera del navegador
+    clicked_at: float = 0.0  # Epoch del clic (o de la petición HTTP) de start/stop
+    network: dict = field(default_factory=dict)  # Peticiones bloqueadas/cacheadas y bytes ahorrados
+    click_error: float = None  # Segundos entre la hora objetivo del clic y el clic real (modo dos fases)
+    started_at: float = 0.0  # Epoch de inicio de la cuenta (tras el escalonado)
+    run_id: str = ""  # Identificador del fichaje en logs y registro
+    steps: dict = field(default_factory=dict)  # Segundos acumulados por paso (timed_step)
+
+
+def load_accounts() -> list:
+    """Carga las cuentas desde ACCOUNTS_FILE o, si no existe, la cuenta única de las variables de entorno.
+
+    Formato del fichero: lista JSON de objetos con name, username, password
+    (o password_env con el nombre de una variable de entorno), chat_id,
+    morning, afternoon, days, schedule (horas de las acciones de
+    ACTIONS_FILE) y holidays (ficheros de festivos de la cuenta, p. ej. los
+    de su comunidad). Solo username y password son obligatorios.
+    """
+    if not ACCOUNTS_FILE:
+        return [Account(name=USERNAME, username=USERNAME, password=PASSWORD, chat_id=TELEGRAM_CHAT_ID)]
+    
+    with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    
+    loaded = []
+    for entry in entries:
+        password = entry.get("password") or os.getenv(entry.get("password_env", ""), "")
+        if not entry.get("username") or not password:
+            raise ValueError(f"Cuenta incompleta en {ACCOUNTS_FILE}: {entry.get('name') or entry.get('username')}")
+        loaded.append(Account(
+            name=entry.get("name", entry["username"]),
+            username=entry["username"],
+            password=password,
+            chat_id=str(entry.get("chat_id", TELEGRAM_CHAT_ID)),
+            morning=entry.get("morning", "09:00"),
+            afternoon=entry.get("afternoon", "18:00"),
+            days=entry.get("days", "mon-fri"),
+            schedule=entry.get("schedule", {}),
+            holidays=[entry["holidays"]] if isinstance(entry.get("holidays"), str) else entry.get("holidays", []),
+        ))
+    if len({a.name for a in loaded}) != len(loaded):
+        raise ValueError(f"Nombres de cuenta duplicados en {ACCOUNTS_FILE}")
+    return loaded
+
+
+# Cuentas cargadas (se rellena en main)
+roster = []
+
+
+def _account_tag(account: Account) -> str:
+    """Etiqueta para logs y mensajes (vacía en modo de cuenta única)"""
+    return f" [{account.name}]" if len(roster) > 1 else ""
+
+
+
+class Metrics:
+    """Registro mínimo de contadores, gauges e histogramas en formato texto de Prometheus"""
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+    def __init__(self):
+        self._help = {}
+        self._types = {}
+        self._values = {}
+        self._histograms = {}
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._types[name] = kind
+        self._help[name] = help_text
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, labels: dict = None, value: float = 1) -> None:
+        key = (name, self._key(labels))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels: dict = None) -> None:
+        self._values[(name, self._key(labels))] = value
+
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        key = (name, self._key(labels))
+        hist = self._histograms.setdefault(key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+    @staticmethod
+    def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def export(self) -> dict:
+        """Valores e histogramas serializables en JSON (para enviarlos desde otro proceso)"""
+        return {
+            "values": [[name, list(labels), value] for (name, labels), value in self._values.items()],
+            "histograms": [[name, list(labels), hist] for (name, labels), hist in self._histograms.items()],
+        }
+
+    def merge(self, exported: dict) -> None:
+        """Suma lo exportado por otro proceso: contadores e histogramas se acumulan, los gauges se sustituyen"""
+        for name, labels, value in exported.get("values", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if self._types.get(name) == "gauge":
+                self._values[key] = value
+            else:
+                self._values[key] = self._values.get(key, 0) + value
+        for name, labels, other in exported.get("histograms", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            hist = self._histograms.setdefault(key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+            hist["buckets"] = [a + b for a, b in zip(hist["buckets"], other["buckets"])]
+            hist["sum"] += other["sum"]
+            hist["count"] += other["count"]
+
+    def histogram_totals(self, name: str, label: str) -> dict:
+        """Devuelve {valor de la etiqueta: (count, sum)} de un histograma"""
+        totals = {}
+        for (n, labels), hist in self._histograms.items():
+            if n == name:
+                key = dict(labels).get(label, "")
+                count, total = totals.get(key, (0, 0.0))
+                totals[key] = (count + hist["count"], total + hist["sum"])
+        return totals
+
+    def render(self) -> str:
+        lines = []
+        names = sorted({n for n, _ in self._values} | {n for n, _ in self._histograms} | set(self._types))
+        for name in names:
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+            for (n, labels), value in sorted(self._values.items()):
+                if n == name:
+                    lines.append(f"{name}{self._fmt_labels(labels)} {value}")
+            for (n, labels), hist in sorted(self._histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, hist["buckets"]):
+                    lines.append(f"{name}_bucket{self._fmt_labels(labels, (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._fmt_labels(labels, (('le', '+Inf'),))} {hist['count']}")
+                lines.append(f"{name}_sum{self._fmt_labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{self._fmt_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bixpe_step_duration_seconds", "histogram", "Duración de cada paso del fichaje")
+metrics.describe("bixpe_steps_total", "counter", "Pasos ejecutados por resultado")
+metrics.describe("bixpe_wait_seconds", "histogram", "Duración de cada espera del navegador")
+metrics.describe("bixpe_runs_total", "counter", "Fichajes por acción, motor y resultado")
+metrics.describe("bixpe_time_to_click_seconds", "histogram", "Retraso del clic respecto a la hora programada")
+metrics.describe("bixpe_telegram_messages_total", "counter", "Envíos a Telegram por tipo y resultado")
+metrics.describe("bixpe_telegram_retries_total", "counter", "Reintentos de envío a Telegram")
+metrics.describe("bixpe_browser_rss_bytes", "gauge", "Memoria residente de los procesos hijos (driver y Chromium)")
+metrics.describe("bixpe_process_rss_bytes", "gauge", "Memoria residente del proceso del bot")
+metrics.describe("bixpe_click_error_seconds", "histogram", "Error del clic respecto a la hora objetivo (dos fases)")
+metrics.describe("bixpe_preclick_lead_seconds", "gauge", "Antelación con la que se prepara cada acción")
+metrics.describe("bixpe_requests_saved_total", "counter", "Peticiones del navegador evitadas por motivo")
+metrics.describe("bixpe_bytes_saved_total", "counter", "Bytes servidos desde la caché local de recursos")
+metrics.describe("bixpe_jobs_aborted_total", "counter", "Jobs de fichaje abortados por tiempo o cancelación")
+metrics.describe("bixpe_jobs_inflight", "gauge", "Jobs de fichaje en curso")
+metrics.describe("bixpe_step_retries_total", "counter", "Reintentos de pasos del flujo del navegador")
+metrics.describe("bixpe_event_loop_lag_seconds", "gauge", "Retraso del event loop en la última medición")
+metrics.describe("bixpe_event_loop_stalls_total", "counter", "Veces que el retraso del loop superó LOOP_LAG_THRESHOLD")
+metrics.describe("bixpe_telegram_up", "gauge", "Conexión con la API de Telegram (1 = ok)")
+metrics.describe("bixpe_runs_skipped_total", "counter", "Fichajes omitidos por festivo o vacaciones")
+metrics.describe("bixpe_browser_workers_total", "counter", "Subprocesos del navegador por resultado (BROWSER_WORKER)")
+
+
+# Pasos de la cuenta que se está fichando en la tarea actual (para el registro de fichajes)
+_run_steps = ContextVar("run_steps", default=None)
+
+
+def observe_step(step: str, elapsed: float) -> None:
+    """Registra la duración de un paso en las métricas, en los pasos de la cuenta en curso y en el log"""
+    metrics.observe("bixpe_step_duration_seconds", elapsed, {"step": step})
+    logger.debug(f"⏱️ Paso '{step}': {elapsed:.3f}s", extra={"step": step, "duration": round(elapsed, 4)})
+    steps = _run_steps.get()
+    if steps is not None:
+        steps[step] = round(steps.get(step, 0.0) + elapsed, 4)
+
+
+@contextmanager
+def timed_step(step: str):
+    """Mide un paso del fichaje y cuenta si terminó bien o con error"""
+    started = time.perf_counter()
+    token = _log_context.set({**_log_context.get(), "step": step})
+    try:
+        yield
+    except BaseException:
+        metrics.inc("bixpe_steps_total", {"step": step, "result": "error"})
+        raise
+    else:
+        metrics.inc("bixpe_steps_total", {"step": step, "result": "ok"})
+    finally:
+        _log_context.reset(token)
+        observe_step(step, time.perf_counter() - started)
+
+
+def _read_rss(pid) -> int:
+    """RSS en bytes de un proceso según /proc (0 si no está disponible)"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def _child_processes_rss() -> int:
+    """Suma el RSS de todos los descendientes del proceso (driver de Playwright y Chromium)"""
+    if not os.path.isdir("/proc"):
+        return 0
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # El nombre del proceso va entre paréntesis y puede contener espacios
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            parents.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+    total, pending = 0, list(parents.get(os.getpid(), []))
+    while pending:
+        pid = pending.pop()
+        total += _read_rss(pid)
+        pending.extend(parents.get(pid, []))
+    return total
+
+
+def record_run_metrics(result: RunResult, scheduled_at: float = None) -> None:
+    """Vuelca en las métricas el resultado de un fichaje"""
+    metrics.inc("bixpe_runs_total", {
+        "action": result.action, "engine": result.engine or "none", "result": "ok" if result.ok else "error"
+    })
+    metrics.observe("bixpe_step_duration_seconds", result.duration, {"step": "task"})
+    for name, secs in result.waits.items():
+        metrics.observe("bixpe_wait_seconds", secs, {"wait": name})
+    if scheduled_at and result.clicked_at:
+        metrics.observe("bixpe_time_to_click_seconds", max(0.0, result.clicked_at - scheduled_at), {"action": result.action})
+    if result.click_error is not None:
+        metrics.observe("bixpe_click_error_seconds", max(0.0, result.click_error), {"action": result.action})
+    for reason in ("blocked", "cached"):
+        if result.network.get(reason):
+            metrics.inc("bixpe_requests_saved_total", {"reason": reason}, result.network[reason])
+    if result.network.get("bytes_saved"):
+        metrics.inc("bixpe_bytes_saved_total", value=result.network["bytes_saved"])
+
+
+async def sleep_until(epoch: float) -> None:
+    """Duerme hasta un instante (epoch) recalculando contra el reloj para no acumular deriva"""
+    while True:
+        remaining = epoch - time.time()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, 30))
+
+
+class ClickGate:
+    """Separa la preparación de un fichaje (login, página lista) del clic.
+
+    Mientras prepara, la cuenta ocupa un hueco de concurrencia. Al llegar a
+    commit() lo libera y espera a la hora objetivo (más un desfase aleatorio
+    de hasta `jitter` segundos). Sin hora objetivo, commit() vuelve en el acto.
+    """
+
+    def __init__(self, target: float = None, slot: asyncio.Semaphore = None, jitter: float = 0.0):
+        self.target = target + random.uniform(0, jitter) if target else None
+        self.slot = slot
+        self.prepared_at = None
+        self.waited = 0.0  # Segundos esperando a la hora objetivo
+        self._holding = False
+
+    async def __aenter__(self):
+        if self.slot is not None:
+            await self.slot.acquire()
+            self._holding = True
+        return self
+
+    async def __aexit__(self, *exc):
+        self._release()
+
+    def _release(self) -> None:
+        if self._holding:
+            self.slot.release()
+            self._holding = False
+
+    def mark_prepared(self, at: float = None) -> None:
+        """Anota el fin de la preparación y libera el hueco de concurrencia"""
+        if self.prepared_at is None:
+            self.prepared_at = at or time.time()
+            self._release()
+
+    async def commit(self) -> None:
+        """Marca el fin de la preparación y espera a la hora del clic"""
+        self.mark_prepared()
+        if self.target:
+            if self.prepared_at > self.target:
+                logger.warning(f"⚠️ Preparación terminada {self.prepared_at - self.target:.1f}s tarde - se pulsa ya")
+            else:
+                logger.info(f"🎯 Preparado {self.target - self.prepared_at:.1f}s antes de la hora, esperando para pulsar...")
+            started = time.perf_counter()
+            await sleep_until(self.target)
+            self.waited += time.perf_counter() - started
+
+    def error(self, clicked_at: float):
+        """Diferencia (s) entre el clic real y la hora objetivo, o None si no aplica"""
+        if not self.target or not clicked_at:
+            return None
+        return clicked_at - self.target
+
+
+class LeadEstimator:
+    """Calcula con cuánta antelación preparar cada acción a partir de lo que tardaron las últimas"""
+
+    def __init__(self, min_lead: float, max_lead: float, margin: float = 1.5, window: int = 20):
+        self.min_lead = min_lead
+        self.max_lead = max(min_lead, max_lead)
+        self.margin = margin
+        self.window = window
+        self._history = {}
+
+    def record(self, action: str, seconds: float) -> None:
+        history = self._history.setdefault(action, [])
+        history.append(seconds)
+        del history[:-self.window]
+
+    def lead(self, action: str) -> float:
+        """Peor preparación reciente con margen, acotada; sin historial se usa el máximo"""
+        history = self._history.get(action)
+        if not history:
+            return self.max_lead
+        return min(self.max_lead, max(self.min_lead, max(history) * self.margin + 5))
+
+
+lead_estimator = LeadEstimator(PRECLICK_MIN_LEAD, PRECLICK_MAX_LEAD)
+
+
+class BrowserManager:
+    """Mantiene un único driver de Playwright y un Chromium caliente entre tareas.
+
+    Cada tarea recibe un BrowserContext nuevo y aislado. El navegador se relanza
+    si se ha caído, se recicla tras BROWSER_MAX_USES contextos y se cierra tras
+    BROWSER_IDLE_TIMEOUT segundos sin uso.
+    """
+
+    def __init__(self, headless: bool, max_uses: int, idle_timeout: float):
+        self.headless = headless
+        self.max_uses = max(1, max_uses)
+        self.idle_timeout = idle_timeout
+        self._playwright = None
+        self._browser = None
+        self._uses = 0
+        self._active = 0
+        self._lock = asyncio.Lock()
+        self._idle_handle = None
+
+    @property
+    def is_running(self) -> bool:
+        """Indica si hay un navegador lanzado y conectado"""
+        return self._browser is not None and self._browser.is_connected()
+
+    def state(self) -> dict:
+        """Estado del navegador para /healthz"""
+        if self._browser is None:
+            state = "stopped"
+        elif self._browser.is_connected():
+            state = "running"
+        else:
+            state = "disconnected"
+        return {"state": state, "driver": self._playwright is not None, "contexts": self._active, "uses": self._uses}
+
+    async def _launch(self) -> None:
+        """Arranca el driver (si hace falta) y lanza Chromium"""
+        if self._playwright is None:
+            self._playwright = await load_playwright()().start()
+        logger.info("🚀 Lanzando navegador Chrome...")
+        with timed_step("browser_launch"):
+            self._browser = await self._playwright.chromium.launch(headless=self.headless)
+        self._browser.on("disconnected", lambda _: logger.warning("⚠️ Navegador desconectado"))
+        self._uses = 0
+
+    async def _close_browser(self) -> None:
+        """Cierra el navegador actual (el driver se mantiene)"""
+        browser, self._browser = self._browser, None
+        if browser is not None:
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Error al cerrar navegador: {e}")
+
+    async def _get_browser(self, own: int = 0):
+        """Devuelve un navegador sano, relanzándolo o reciclándolo si es necesario.
+
+        own es cuántos de los usuarios contados en _active son del propio
+        llamador (new_context ya se ha contado): solo se recicla si no hay otros.
+        """
+        async with self._lock:
+            if self._browser is not None and not self._browser.is_connected():
+                logger.warning("⚠️ Navegador caído, relanzando...")
+                await self._close_browser()
+            if self._browser is not None and self._active <= own and self._uses >= self.max_uses:
+                logger.info(f"♻️ Reciclando navegador tras {self._uses} usos")
+                await self._close_browser()
+            if self._browser is None:
+                await self._launch()
+            return self._browser
+
+    @asynccontextmanager
+    async def new_context(self, **kwargs):
+        """Entrega un BrowserContext nuevo y lo cierra al terminar"""
+        self._cancel_idle_timer()
+        self._active += 1
+        context = None
+        try:
+            with timed_step("browser_context"):
+                browser = await self._get_browser(own=1)
+                try:
+                    context = await browser.new_context(**kwargs)
+                except Exception as e:
+                    # El proceso puede haber muerto sin emitir "disconnected": relanzar una vez
+                    logger.warning(f"⚠️ No se pudo crear contexto ({e}), relanzando navegador...")
+                    async with self._lock:
+                        await self._close_browser()
+                    browser = await self._get_browser(own=1)
+                    context = await browser.new_context(**kwargs)
+            self._uses += 1
+            yield context
+        finally:
+            if context is not None:
+                try:
+                    # Acotado: un Chromium colgado no debe bloquear la cancelación de la tarea
+                    await asyncio.wait_for(context.close(), 10)
+                except Exception as e:
+                    logger.warning(f"⚠️ Error al cerrar contexto: {e}")
+            self._active -= 1
+            if self._active == 0:
+                await self._on_idle()
+
+    async def _on_idle(self) -> None:
+        """Recicla el navegador si ha agotado sus usos o arma el temporizador de inactividad"""
+        if self._uses >= self.max_uses:
+            async with self._lock:
+                if self._active == 0:
+                    logger.info(f"♻️ Reciclando navegador tras {self._uses} usos")
+                    await self._close_browser()
+            return
+        self._arm_idle_timer()
+
+    def _arm_idle_timer(self) -> None:
+        self._cancel_idle_timer()
+        if self.idle_timeout > 0:
+            loop = asyncio.get_running_loop()
+            self._idle_handle = loop.call_later(
+                self.idle_timeout, lambda: asyncio.ensure_future(self._close_if_idle())
+            )
+
+    def _cancel_idle_timer(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    async def _close_if_idle(self) -> None:
+        self._idle_handle = None
+        async with self._lock:
+            if self._active == 0 and self._browser is not None:
+                logger.info("💤 Navegador inactivo, cerrándolo para liberar memoria")
+                await self._close_browser()
+
+    async def prewarm(self) -> None:
+        """Lanza el navegador por adelantado para que el fichaje no pague el arranque en frío"""
+        try:
+            await self._get_browser()
+            logger.info("🔥 Navegador precalentado")
+            if self._active == 0:
+                self._arm_idle_timer()
+        except Exception as e:
+            logger.error(f"❌ Error al precalentar navegador: {e}")
+
+    async def abort(self) -> None:
+        """Cierra el navegador sin esperar al lock, para recuperarse de un Chromium colgado"""
+        self._cancel_idle_timer()
+        browser, self._browser = self._browser, None
+        if browser is None:
+            return
+        logger.warning("🧨 Cerrando navegador tras abortar la tarea")
+        try:
+            await asyncio.wait_for(browser.close(), 10)
+        except Exception as e:
+            # Si ni siquiera responde al cierre, parar el driver mata el proceso
+            logger.warning(f"⚠️ El navegador no responde ({e!r}), deteniendo Playwright")
+            playwright, self._playwright = self._playwright, None
+            if playwright is not None:
+                try:
+                    await asyncio.wait_for(playwright.stop(), 10)
+                except Exception:
+                    pass
+
+    async def close(self) -> None:
+        """Cierra navegador y driver de Playwright"""
+        self._cancel_idle_timer()
+        async with self._lock:
+            await self._close_browser()
+            if self._playwright is not None:
+                try:
+                    await self._playwright.stop()
+                except Exception as e:
+                    logger.warning(f"⚠️ Error al detener Playwright: {e}")
+                self._playwright = None
+
+
+# Navegador compartido por todas las tareas
+browser_manager = BrowserManager(HEADLESS, BROWSER_MAX_USES, BROWSER_IDLE_TIMEOUT)
+
+
+class TelegramOutbox:
+    """Cola de salida de Telegram con un worker propio.
+
+    Las tareas solo encolan y siguen; el worker respeta los límites de Telegram
+    (por chat y global), agrupa ráfagas de mensajes de texto en uno solo, envía
+    las fotos seguidas como álbum (send_media_group) y persiste en disco lo no
+    entregado para reintentarlo tras un reinicio. Los textos se guardan al
+    encolarlos; las fotos viven en memoria y solo se vuelcan a disco si un
+    envío falla o siguen pendientes al detenerse.
+    """
+
+    MAX_TEXT = 4000  # Margen bajo el límite de 4096 caracteres de Telegram
+    MAX_ALBUM = 10  # Fotos máximas por send_media_group
+
+    def __init__(self, directory: str, chat_interval: float, global_rate: float, coalesce: float, max_attempts: int):
+        self.directory = directory
+        self.chat_interval = chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.coalesce = coalesce
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._pending = {}  # chat_id -> lista de items en orden de llegada
+        self._next_allowed = {}  # chat_id -> instante (monotonic) del próximo envío permitido
+        self._next_global = 0.0
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker = None
+        self._seq = 0
+        # Un único hilo para la E/S de disco: mantiene el orden y no bloquea el loop
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox-io")
+
+    def __len__(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    # --- Persistencia ---
+
+    def _item_path(self, item_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{item_id}.{suffix}")
+
+    def _write_item(self, item: dict, photo: bytes = None) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if photo is not None:
+            with open(self._item_path(item["id"], "bin"), "wb") as f:
+                f.write(photo)
+        tmp_path = self._item_path(item["id"], "tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({k: v for k, v in item.items() if k != "photo"}, f)
+        os.replace(tmp_path, self._item_path(item["id"], "json"))
+
+    def _delete_item(self, item_id: str) -> None:
+        for suffix in ("json", "bin"):
+            try:
+                os.remove(self._item_path(item_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _persist(self, item: dict) -> None:
+        item["stored"] = True
+        asyncio.get_running_loop().run_in_executor(self._io, self._write_item, item, item.get("photo"))
+
+    def _spill(self, items: list) -> None:
+        """Vuelca a disco las fotos que aún solo están en memoria"""
+        for item in items:
+            if not item.get("stored"):
+                self._persist(item)
+
+    def _forget(self, items: list) -> None:
+        loop = asyncio.get_running_loop()
+        for item in items:
+            if item.get("stored"):
+                loop.run_in_executor(self._io, self._delete_item, item["id"])
+
+    def load(self) -> int:
+        """Recupera los envíos pendientes que quedaron en disco"""
+        if not os.path.isdir(self.directory):
+            return 0
+        restored = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            item_id = name[:-len(".json")]
+            try:
+                with open(self._item_path(item_id, "json"), "r", encoding="utf-8") as f:
+                    item = json.load(f)
+                if item["kind"] == "photo":
+                    with open(self._item_path(item_id, "bin"), "rb") as f:
+                        item["photo"] = f.read()
+            except Exception as e:
+                logger.warning(f"⚠️ Envío pendiente ilegible ({name}), se descarta: {e}")
+                self._delete_item(item_id)
+                continue
+            item.update(queued_at=time.monotonic(), stored=True)
+            self._pending.setdefault(item["chat_id"], []).append(item)
+            restored += 1
+        if restored:
+            self._idle.clear()
+            self._wake.set()
+        return restored
+
+    # --- Encolado ---
+
+    def _enqueue(self, item: dict) -> None:
+        self._seq += 1
+        item.update(id=f"{time.time_ns()}_{self._seq:06d}", created=time.time(), attempts=0, queued_at=time.monotonic())
+        self._pending.setdefault(item["chat_id"], []).append(item)
+        if item["kind"] != "photo":
+            self._persist(item)
+        self._idle.clear()
+        self._wake.set()
+
+    def enqueue_message(self, chat_id: str, text: str) -> None:
+        """Encola un mensaje de texto (HTML)"""
+        self._enqueue({"kind": "message", "chat_id": str(chat_id), "text": text})
+
+    def enqueue_photo(self, chat_id: str, photo: bytes, caption: str = "") -> None:
+        """Encola una foto en memoria con su pie"""
+        self._enqueue({"kind": "photo", "chat_id": str(chat_id), "text": caption, "photo": photo})
+
+    # --- Worker ---
+
+    def start(self, bot) -> None:
+        """Arranca el worker de envío en el loop actual"""
+        self.bot = bot
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name="telegram-outbox")
+
+    async def flush(self, timeout: float) -> bool:
+        """Espera a que se vacíe la cola (True) o a que venza el timeout (False)"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Intenta vaciar la cola y detiene el worker; lo pendiente queda en disco"""
+        if self._worker is not None:
+            if not await self.flush(timeout):
+                logger.warning(f"⚠️ Quedan {len(self)} envíos pendientes de Telegram, se reintentarán al arrancar")
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for items in self._pending.values():
+            self._spill(items)
+        await asyncio.get_running_loop().run_in_executor(self._io, lambda: None)
+
+    def _next_batch(self):
+        """Elige el siguiente lote listo para enviar, o cuánto esperar hasta que lo haya"""
+        now = time.monotonic()
+        best_chat, wait = None, None
+        for chat_id, items in self._pending.items():
+            if not items:
+                continue
+            # Dejar que una ráfaga se acumule un poco para agruparla
+            ready_at = max(self._next_allowed.get(chat_id, 0.0), items[0]["queued_at"] + self.coalesce)
+            if ready_at <= now:
+                if best_chat is None or items[0]["queued_at"] < self._pending[best_chat][0]["queued_at"]:
+                    best_chat = chat_id
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        if best_chat is None:
+            return None, wait
+        
+        items = self._pending[best_chat]
+        batch = [items[0]]
+        if items[0].get("solo"):
+            # Venía de un lote rechazado por Telegram: se envía suelto para aislar el que falla
+            return (best_chat, batch), None
+        if items[0]["kind"] == "message":
+            size = len(items[0]["text"])
+            for item in items[1:]:
+                if item["kind"] != "message" or item.get("solo") or size + len(item["text"]) + 2 > self.MAX_TEXT:
+                    break
+                batch.append(item)
+                size += len(item["text"]) + 2
+        else:
+            for item in items[1:self.MAX_ALBUM]:
+                if item["kind"] != "photo" or item.get("solo"):
+                    break
+                batch.append(item)
+        return (best_chat, batch), None
+
+    async def _send(self, chat_id: str, batch: list) -> None:
+        if batch[0]["kind"] == "message":
+            with timed_step("telegram_message"):
+                await self.bot.send_message(
+                    chat_id=chat_id,
+                    text="\n\n".join(item["text"] for item in batch),
+                    parse_mode="HTML"
+                )
+        elif len(batch) == 1:
+            with timed_step("telegram_photo"):
+                await self.bot.send_photo(chat_id=chat_id, photo=batch[0]["photo"], caption=batch[0]["text"])
+        else:
+            with timed_step("telegram_album"):
+                await self.bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[InputMediaPhoto(media=item["photo"], caption=item["text"]) for item in batch]
+                )
+
+    async def _run(self) -> None:
+        while True:
+            selected, wait = self._next_batch()
+            if selected is None:
+                if not len(self):
+                    self._idle.set()
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            chat_id, batch = selected
+            # Límite global de envíos por segundo
+            delay = self._next_global - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_global = time.monotonic() + self.global_interval
+            
+            kind = batch[0]["kind"]
+            try:
+                await self._send(chat_id, batch)
+            except RetryAfter as e:
+                watchdog.telegram_seen(True)
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logger.warning(f"⚠️ Telegram pide esperar {retry_after:.0f}s antes de volver a enviar")
+                metrics.inc("bixpe_telegram_retries_total")
+                self._spill(batch)
+                self._next_global = time.monotonic() + retry_after
+                self._next_allowed[chat_id] = time.monotonic() + retry_after
+                continue
+            except (BadRequest, Forbidden) as e:
+                # Rechazo definitivo (HTML mal formado, chat bloqueado...): reintentar no sirve
+                watchdog.telegram_seen(True)
+                if len(batch) > 1:
+                    logger.warning(f"⚠️ Telegram rechazó un lote de {len(batch)}, se reenvían por separado: {e}")
+                    for item in batch:
+                        item["solo"] = True
+                    continue
+                logger.error(f"❌ Telegram rechazó el envío, se descarta: {e}")
+                metrics.inc("bixpe_telegram_messages_total", {"kind": kind, "result": "error"})
+                del self._pending[chat_id][:1]
+                self._forget(batch)
+                self._next_allowed[chat_id] = time.monotonic() + self.chat_interval
+                continue
+            except Exception as e:
+                # Solo los fallos de red o de token dicen que Telegram no está disponible
+                if isinstance(e, (NetworkError, InvalidToken)):
+                    watchdog.telegram_seen(False, str(e) or type(e).__name__)
+                elif isinstance(e, TelegramError):
+                    watchdog.telegram_seen(True)
+                attempts = max(item["attempts"] for item in batch) + 1
+                for item in batch:
+                    item["attempts"] = attempts
+                if attempts >= self.max_attempts:
+                    logger.error(f"❌ Error al enviar a Telegram (después de {attempts} intentos), se descarta: {e}")
+                    metrics.inc("bixpe_telegram_messages_total", {"kind": kind, "result": "error"}, len(batch))
+                    del self._pending[chat_id][:len(batch)]
+                    self._forget(batch)
+                else:
+                    # Lo que no se pudo enviar ya no se confía solo a la memoria
+                    self._spill(batch)
+                    wait_time = min(2 ** (attempts - 1), 300)  # Backoff exponencial: 1s, 2s, 4s...
+                    logger.warning(f"⚠️ Intento {attempts} fallido al enviar a Telegram, reintentando en {wait_time}s: {e}")
+                    metrics.inc("bixpe_telegram_retries_total")
+                    self._next_allowed[chat_id] = time.monotonic() + wait_time
+                continue
+            
+            metrics.inc("bixpe_telegram_messages_total", {"kind": kind, "result": "ok"}, len(batch))
+            watchdog.telegram_seen(True)
+            del self._pending[chat_id][:len(batch)]
+            self._forget(batch)
+            self._next_allowed[chat_id] = time.monotonic() + self.chat_interval
+            logger.info(f"📱 Enviado por Telegram: {len(batch)} {'mensaje(s)' if kind == 'message' else 'foto(s)'}")
+
+
+# Cola de salida de Telegram compartida
+outbox = TelegramOutbox(
+    os.path.join(DATA_DIR, "outbox"),
+    TELEGRAM_CHAT_INTERVAL,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_COALESCE_SECONDS,
+    TELEGRAM_MAX_ATTEMPTS
+)
+
+
+def ledger_day(epoch: float = None) -> str:
+    """Día (YYYY-MM-DD, hora de Madrid) al que pertenece un fichaje"""
+    return datetime.fromtimestamp(epoch or time.time(), TIMEZONE).strftime("%Y-%m-%d")
+
+
+class RunLedger:
+    """Registro persistente en SQLite de cada fichaje, indexado por cuenta y día.
+
+    Tras un reinicio permite saber si la acción de hoy ya se hizo (para no
+    fichar dos veces ni perder un día), alimenta /history y la recuperación
+    al arrancar. Las acciones correctas recientes se guardan también en
+    memoria para consultarlas sin tocar el disco. La conexión vive en un
+    único hilo de E/S.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT,
+            account TEXT NOT NULL,
+            action TEXT NOT NULL,
+            day TEXT NOT NULL,
+            trigger TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            engine TEXT,
+            error TEXT,
+            scheduled_at REAL,
+            started_at REAL NOT NULL,
+            clicked_at REAL,
+            finished_at REAL NOT NULL,
+            duration REAL,
+            click_error REAL,
+            steps TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_runs_account_day ON runs (account, day, action, ok);
+        CREATE INDEX IF NOT EXISTS idx_runs_finished ON runs (finished_at);
+    """
+    RECENT_DAYS = 7  # Días de acciones correctas que se cargan en memoria
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._done = set()  # (cuenta, día, acción) ya fichadas con éxito
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger-io")
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+            # Registros creados antes de que existiera run_id
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(runs)")}
+            if "run_id" not in columns:
+                self._conn.execute("ALTER TABLE runs ADD COLUMN run_id TEXT")
+        return self._conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    def _load_done(self, since: str) -> list:
+        rows = self._db().execute(
+            "SELECT DISTINCT account, day, action FROM runs WHERE ok = 1 AND day >= ?", (since,)
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    async def load(self) -> int:
+        """Abre la base de datos y carga en memoria las acciones correctas recientes"""
+        since = ledger_day(time.time() - self.RECENT_DAYS * 86400)
+        self._done.update(await self._run(self._load_done, since))
+        return len(self._done)
+
+    def is_done(self, account: str, day: str, action: str) -> bool:
+        """Indica si la acción ya se hizo con éxito ese día (consulta en memoria)"""
+        return (account, day, action) in self._done
+
+    def _insert(self, row: dict) -> None:
+        db = self._db()
+        with db:
+            db.execute(
+                f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                tuple(row.values())
+            )
+
+    async def record(self, result: RunResult, scheduled_at: float = None, trigger: str = "schedule") -> None:
+        """Guarda el resultado de una cuenta"""
+        finished_at = time.time()
+        day = ledger_day(scheduled_at or result.started_at or finished_at)
+        row = {
+            "run_id": result.run_id or None,
+            "account": result.account,
+            "action": result.action,
+            "day": day,
+            "trigger": trigger,
+            "ok": int(result.ok),
+            "engine": result.engine,
+            "error": result.error,
+            "scheduled_at": scheduled_at,
+            "started_at": result.started_at or finished_at,
+            "clicked_at": result.clicked_at or None,
+            "finished_at": finished_at,
+            "duration": round(result.duration, 4),
+            "click_error": result.click_error,
+            "steps": json.dumps(result.steps) if result.steps else None,
+        }
+        if result.ok:
+            self._done.add((result.account, day, result.action))
+        try:
+            await self._run(self._insert, row)
+        except Exception as e:
+            logger.error(f"❌ Error al guardar en el registro de fichajes: {e}")
+
+    def _query(self, limit: int, accounts: list = None) -> list:
+        sql = "SELECT * FROM runs"
+        args = []
+        if accounts is not None:
+            sql += f" WHERE account IN ({', '.join('?' * len(accounts))})"
+            args.extend(accounts)
+        sql += " ORDER BY finished_at DESC LIMIT ?"
+        args.append(limit)
+        return [dict(row) for row in self._db().execute(sql, args).fetchall()]
+
+    async def history(self, limit: int = 10, accounts: list = None) -> list:
+        """Últimos fichajes (el más reciente primero), opcionalmente solo de ciertas cuentas"""
+        return await self._run(self._query, limit, accounts)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        await self._run(self._close)
+
+
+# Registro de fichajes compartido
+ledger = RunLedger(LEDGER_PATH)
+
+
+def _parse_day(text: str) -> date:
+    """Fecha en formato AAAA-MM-DD, DD/MM/AAAA o DD/MM (año en curso)"""
+    text = text.strip()
+    # Sin año se completa antes de analizar: strptime usaría 1900 y rechazaría el 29/02
+    value = f"{text}/{datetime.now(TIMEZONE).year}" if text.count("/") == 1 else text
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"'{text}'")
+
+
+def _ics_date(value: str):
+    """Fecha de un DTSTART/DTEND/UNTIL de ICS (YYYYMMDD o YYYYMMDDTHHMMSS[Z]) y si tenía hora"""
+    return date(int(value[0:4]), int(value[4:6]), int(value[6:8])), "T" in value and value.split("T", 1)[1][:6] != "000000"
+
+
+def _parse_ics(text: str, start: date, end: date) -> dict:
+    """Días (ISO) entre start y end con eventos en un calendario ICS: {día: nombre}.
+
+    Admite eventos de día completo, de varios días (DTEND exclusivo) y
+    repetidos cada año (RRULE:FREQ=YEARLY con COUNT o UNTIL opcionales), que
+    es como suelen publicarse los calendarios de festivos. Los eventos con
+    hora (una reunión, una guardia) no hacen libre el día y se ignoran.
+    """
+    # Las líneas largas de ICS continúan en la siguiente con un espacio o tabulador
+    lines = text.replace("\r\n", "\n").replace("\n ", "").replace("\n\t", "").split("\n")
+    days, event = {}, None
+    for line in lines:
+        if line == "BEGIN:VEVENT":
+            event = {}
+        elif line == "END:VEVENT" and event is not None:
+            if "DTSTART" in event:
+                _expand_ics_event(event, start, end, days)
+            event = None
+        elif event is not None and ":" in line:
+            name, value = line.split(":", 1)
+            event[name.split(";", 1)[0].upper()] = value.strip()
+    return days
+
+
+def _expand_ics_event(event: dict, start: date, end: date, days: dict) -> None:
+    first, timed = _ics_date(event["DTSTART"])
+    if timed:
+        return
+    last = first
+    if "DTEND" in event:
+        last, timed = _ics_date(event["DTEND"])
+        if not timed and last > first:
+            last -= timedelta(days=1)  # DTEND de día completo es exclusivo
+    name = event.get("SUMMARY", "").replace("\\,", ",") or "Festivo"
+    rule = dict(part.split("=", 1) for part in event.get("RRULE", "").split(";") if "=" in part)
+    occurrences = [(first, last)]
+    if rule.get("FREQ") == "YEARLY":
+        until = _ics_date(rule["UNTIL"])[0] if "UNTIL" in rule else end
+        count = int(rule.get("COUNT", 0)) or None
+        occurrences = []
+        for year in range(first.year, min(until.year, end.year) + 1):
+            try:
+                shifted = first.replace(year=year)
+            except ValueError:  # 29 de febrero
+                continue
+            if shifted > until or (count is not None and len(occurrences) >= count):
+                break
+            occurrences.append((shifted, shifted + (last - first)))
+    for occ_first, occ_last in occurrences:
+        day = max(occ_first, start)
+        while day <= min(occ_last, end):
+            days[day.isoformat()] = name
+            day += timedelta(days=1)
+
+
+def load_holiday_file(path: str, start: date, end: date) -> dict:
+    """Festivos de un fichero ICS o de texto (AAAA-MM-DD y nombre opcional por línea) entre start y end"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.lower().endswith(".ics") or text.lstrip().startswith("BEGIN:VCALENDAR"):
+        return _parse_ics(text, start, end)
+    days = {}
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        value, _, name = line.partition(" ")
+        day = _parse_day(value)
+        if start <= day <= end:
+            days[day.isoformat()] = name.strip() or "Festivo"
+    return days
+
+
+class WorkCalendar:
+    """Índice precalculado de días libres por cuenta: festivos y vacaciones.
+
+    Los festivos salen de ficheros ICS o de texto, comunes (HOLIDAYS_FILES) o
+    de cada cuenta (holidays en ACCOUNTS_FILE). Las vacaciones se gestionan
+    con /vacation y se guardan en VACATIONS_FILE. Para cada cuenta se guarda
+    un dict {día: (tipo, motivo)} que cubre del pasado reciente a un año
+    vista, así que consultarlo antes de cada job cuesta O(1) y un día libre no
+    lanza navegador ni hace login.
+    """
+
+    WINDOW_DAYS = 400
+
+    def __init__(self, holiday_files: list, vacations_path: str):
+        self.holiday_files = holiday_files
+        self.vacations_path = vacations_path
+        self.vacations = []  # {"id", "account" ("*" = todas), "start", "end", "note"}
+        self.skipped = deque(maxlen=20)  # Últimos jobs omitidos: (día, acción, {cuenta: motivo})
+        self.skipped_total = 0
+        self._accounts = []
+        self._holidays = {}  # cuenta -> {día: nombre} (comunes + propios)
+        self._index = {}  # cuenta -> {día: (tipo, motivo)}
+        self._window = ("", "")
+
+    def load(self, accounts: list) -> int:
+        """Carga las vacaciones guardadas y construye el índice; devuelve cuántos días libres hay"""
+        self._accounts = list(accounts)
+        if os.path.exists(self.vacations_path):
+            with open(self.vacations_path, "r", encoding="utf-8") as f:
+                self.vacations = json.load(f)
+        self._load_holidays()
+        self._build()
+        return sum(len(days) for days in self._index.values())
+
+    def _load_holidays(self) -> None:
+        """Lee los ficheros de festivos para la ventana [hoy - 7 días, hoy + WINDOW_DAYS]"""
+        today = datetime.now(TIMEZONE).date()
+        start, end = today - timedelta(days=7), today + timedelta(days=self.WINDOW_DAYS)
+        parsed = {}
+
+        def holidays_of(paths) -> dict:
+            days = {}
+            for path in paths:
+                if path not in parsed:
+                    try:
+                        parsed[path] = load_holiday_file(path, start, end)
+                        logger.info(f"🎉 Festivos de {path}: {len(parsed[path])} días")
+                    except (OSError, ValueError) as e:
+                        logger.error(f"❌ No se pudo leer el fichero de festivos {path}: {e}")
+                        parsed[path] = {}
+                days.update(parsed[path])
+            return days
+
+        common = holidays_of(self.holiday_files)
+        self._holidays = {a.name: {**common, **holidays_of(a.holidays)} for a in self._accounts}
+        self._window = (start.isoformat(), end.isoformat())
+
+    def _build(self) -> None:
+        """Combina festivos y vacaciones en el índice por cuenta"""
+        index = {}
+        for account in self._accounts:
+            days = {day: ("holiday", name) for day, name in self._holidays.get(account.name, {}).items()}
+            for vacation in self.vacations:
+                if vacation["account"] not in ("*", account.name):
+                    continue
+                day, last = date.fromisoformat(vacation["start"]), date.fromisoformat(vacation["end"])
+                while day <= last:
+                    days[day.isoformat()] = ("vacation", vacation["note"] or "Vacaciones")
+                    day += timedelta(days=1)
+            index[account.name] = days
+        self._index = index
+
+    def day_off(self, account: str, day: str):
+        """(tipo, motivo) si la cuenta no trabaja ese día (ISO), o None"""
+        if not self._window[0] <= day <= self._window[1]:
+            # La ventana se desplaza al pasar los días: recargar festivos (una vez al año, más o menos)
+            self._load_holidays()
+            self._build()
+        return self._index.get(account, {}).get(day)
+
+    def upcoming(self, accounts: list, limit: int = 5) -> list:
+        """Próximos días libres (día, motivo, cuentas) de las cuentas dadas"""
+        today = datetime.now(TIMEZONE).date().isoformat()
+        days = {}
+        for name in accounts:
+            for day, (_, reason) in self._index.get(name, {}).items():
+                if day >= today:
+                    days.setdefault((day, reason), []).append(name)
+        return [(day, reason, names) for (day, reason), names in sorted(days.items())[:limit]]
+
+    def record_skip(self, day: str, action: str, off: dict) -> None:
+        """Anota un job omitido por día libre (para /status y las métricas)"""
+        self.skipped.append((day, action, off))
+        self.skipped_total += len(off)
+        for kind, _ in off.values():
+            metrics.inc("bixpe_runs_skipped_total", {"action": action, "reason": kind})
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.vacations_path) or ".", exist_ok=True)
+        tmp_path = f"{self.vacations_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.vacations, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.vacations_path)
+
+    async def add_vacation(self, account: str, start: date, end: date, note: str = "") -> dict:
+        """Añade un rango de vacaciones (account "*" = todas las cuentas) y reconstruye el índice"""
+        vacation = {
+            "id": max((v["id"] for v in self.vacations), default=0) + 1,
+            "account": account,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "note": note,
+        }
+        self.vacations.append(vacation)
+        self._build()
+        await asyncio.to_thread(self._save)
+        return vacation
+
+    async def remove_vacation(self, vacation_id: int):
+        """Elimina un rango de vacaciones por id; devuelve el rango o None si no existe"""
+        for vacation in self.vacations:
+            if vacation["id"] == vacation_id:
+                self.vacations.remove(vacation)
+                self._build()
+                await asyncio.to_thread(self._save)
+                return vacation
+        return None
+
+
+# Festivos y vacaciones por cuenta (se carga en main)
+work_calendar = WorkCalendar(HOLIDAYS_FILES, VACATIONS_FILE)
+
+
+async def send_telegram_notification(message: str, is_error: bool = False, chat_id: str = None) -> None:
+    """Encola una notificación de Telegram (por defecto al chat de administración) y vuelve en el acto"""
+    chat_id = chat_id or TELEGRAM_CHAT_ID
+    if not telegram_bot or not chat_id:
+        logger.warning("⚠️ Telegram no configurado")
+        return
+    
+    emoji = "❌" if is_error else "✅"
+    outbox.enqueue_message(chat_id, f"{emoji} {message}\n\n⏰ {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+
+async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja comando /start para reanudar el bot"""
+    global scheduler, bot_state
+    
+    try:
+        if not bot_state["running"]:
+            bot_state["running"] = True
+            # Un scheduler pausado sigue contando como running: hay que reanudarlo
+            if scheduler and scheduler.state == STATE_PAUSED:
+                scheduler.resume()
+            elif scheduler and not scheduler.running:
+                scheduler.start()
+            
+            logger.info("▶️ BOT REANUDADO POR COMANDO TELEGRAM")
+            await update.message.reply_text(
+                f"▶️ <b>Bot reanudado</b>\n\n"
+                f"Tareas programadas:\n{schedule_summary()}",
+                parse_mode="HTML"
+            )
+            await send_telegram_notification("▶️ <b>Bot REANUDADO</b> - Tareas programadas activas")
+        else:
+            await update.message.reply_text(
+                f"✅ Bot ya está <b>activo</b>\n\n"
+                f"Tareas programadas:\n{schedule_summary()}",
+                parse_mode="HTML"
+            )
+    except Exception as e:
+        logger.error(f"❌ Error en comando /start: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+async def handle_stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja comando /stop para pausar el bot"""
+    global scheduler
+    
+    try:
+        if bot_state["running"]:
+            bot_state["running"] = False
+            if scheduler and scheduler.running:
+                scheduler.pause()
+            
+            logger.info("⏸️ BOT PAUSADO POR COMANDO TELEGRAM")
+            await update.message.reply_text(
+                "⏸️ <b>Bot pausado</b>\n\n"
+                "Las tareas programadas están pausadas.\n"
+                "Usa /start para reanudar.",
+                parse_mode="HTML"
+            )
+            await send_telegram_notification("⏸️ <b>Bot PAUSADO</b> - Las tareas están suspendidas")
+        else:
+            await update.message.reply_text(
+                "⏸️ Bot ya está <b>pausado</b>\n\n"
+                "Usa /start para reanudar.",
+                parse_mode="HTML"
+            )
+    except Exception as e:
+        logger.error(f"❌ Error en comando /stop: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+async def handle_cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja comando /cancel para abortar los fichajes en curso (opcional: una acción, p. ej. start).
+
+    Desde un chat de cuenta solo se cancelan los jobs que afectan únicamente a sus cuentas.
+    """
+    try:
+        accounts = _chat_accounts(update)
+        if not accounts:
+            await update.message.reply_text("ℹ️ Este chat no tiene cuentas asociadas")
+            return
+        action = context.args[0].lower() if context.args else None
+        if action is not None and action not in WORKDAY_ACTIONS:
+            await update.message.reply_text(f"Uso: /cancel [{'|'.join(WORKDAY_ACTIONS)}]")
+            return
+        cancelled = cancel_inflight(action, None if _is_admin_chat(update) else accounts)
+        if cancelled:
+            logger.info(f"🛑 {cancelled} fichaje(s) cancelados por comando Telegram")
+            await update.message.reply_text(f"🛑 <b>{cancelled} fichaje(s) cancelados</b>", parse_mode="HTML")
+        elif _is_admin_chat(update):
+            await update.message.reply_text("ℹ️ No hay fichajes en curso")
+        else:
+            await update.message.reply_text("ℹ️ No hay fichajes en curso solo de tus cuentas")
+    except Exception as e:
+        logger.error(f"❌ Error en comando /cancel: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+def _is_admin_chat(update: Update) -> bool:
+    """Indica si el comando llega desde el chat de administración (TELEGRAM_CHAT_ID)"""
+    return str(update.effective_chat.id) == str(TELEGRAM_CHAT_ID)
+
+
+def _chat_accounts(update: Update) -> list:
+    """Cuentas que puede gestionar el chat del comando: todas desde el de administración,
+    las suyas desde un chat de cuenta y ninguna desde un chat desconocido"""
+    if _is_admin_chat(update):
+        return [a.name for a in roster]
+    chat_id = str(update.effective_chat.id)
+    return [a.name for a in roster if a.chat_id == chat_id]
+
+
+async def handle_vacation_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja /vacation: ver días libres, /vacation add DESDE [HASTA] [cuenta|all] [nota] y /vacation del ID"""
+    usage = (
+        "Uso:\n"
+        "/vacation - Próximos festivos y vacaciones\n"
+        "/vacation add DESDE [HASTA] [cuenta|all] [nota]\n"
+        "/vacation del ID\n\n"
+        "Fechas: AAAA-MM-DD, DD/MM/AAAA o DD/MM"
+    )
+    try:
+        args = list(context.args or [])
+        accounts = _chat_accounts(update)
+        if not accounts:
+            await update.message.reply_text("ℹ️ Este chat no tiene cuentas asociadas")
+            return
+        admin = _is_admin_chat(update)
+        command = args.pop(0).lower() if args else "list"
+        
+        if command == "add":
+            if not args:
+                await update.message.reply_text(usage)
+                return
+            start = end = _parse_day(args.pop(0))
+            if args:
+                try:
+                    end = _parse_day(args[0])
+                    # Sin año y antes del inicio: cruza el año (p. ej. 24/12 06/01)
+                    if end < start and args[0].count("/") == 1:
+                        end = _parse_day(f"{args[0]}/{start.year + 1}")
+                    args.pop(0)
+                except ValueError:
+                    pass
+            if end < start:
+                await update.message.reply_text("❌ La fecha final es anterior a la inicial")
+                return
+            # Solo el chat de administración puede usar "all" o elegir otras cuentas
+            names = {a.name for a in roster}
+            if args and (args[0].lower() in ("all", "todas") or args[0] in names) and not admin and args[0] not in accounts:
+                await update.message.reply_text("❌ Solo puedes añadir vacaciones a tus cuentas")
+                return
+            if args and args[0].lower() in ("all", "todas"):
+                args.pop(0)
+                targets = ["*"]
+            elif args and args[0] in names:
+                targets = [args.pop(0)]
+            else:
+                targets = ["*"] if admin else accounts
+            note = " ".join(args)
+            added = [await work_calendar.add_vacation(target, start, end, note) for target in targets]
+            who = "todas las cuentas" if targets == ["*"] else ", ".join(targets)
+            ids = ", ".join(f"#{v['id']}" for v in added)
+            logger.info(f"🏖️ Vacaciones {start} → {end} añadidas para {who} por comando Telegram")
+            await update.message.reply_text(
+                f"🏖️ <b>Vacaciones añadidas</b> ({ids})\n"
+                f"{start.strftime('%d/%m/%Y')} → {end.strftime('%d/%m/%Y')} - {who}\n\n"
+                f"Esos días no se fichará.",
+                parse_mode="HTML"
+            )
+        
+        elif command in ("del", "rm", "remove"):
+            if not args or not args[0].lstrip("#").isdigit():
+                await update.message.reply_text(usage)
+                return
+            # Desde un chat de cuenta solo se eliminan los rangos de sus cuentas
+            vacation_id = int(args[0].lstrip("#"))
+            owned = admin or any(v["id"] == vacation_id and v["account"] in accounts for v in work_calendar.vacations)
+            removed = await work_calendar.remove_vacation(vacation_id) if owned else None
+            if removed is None:
+                await update.message.reply_text(f"ℹ️ No hay vacaciones con id {args[0]}")
+                return
+            logger.info(f"🗑️ Vacaciones #{removed['id']} eliminadas por comando Telegram")
+            await update.message.reply_text(
+                f"🗑️ Vacaciones #{removed['id']} eliminadas ({removed['start']} → {removed['end']})"
+            )
+        
+        elif command == "list":
+            today = datetime.now(TIMEZONE).date().isoformat()
+            ranges = [
+                v for v in work_calendar.vacations
+                if v["end"] >= today and (v["account"] == "*" or v["account"] in accounts)
+            ]
+            lines = ["<b>🏖️ Vacaciones</b>"]
+            for v in ranges:
+                who = "todas" if v["account"] == "*" else v["account"]
+                note = f" - {v['note']}" if v["note"] else ""
+                lines.append(f"#{v['id']} {v['start']} → {v['end']} ({who}){note}")
+            if not ranges:
+                lines.append("Ninguna programada")
+            lines.append("\n<b>📅 Próximos días libres</b>")
+            for day, reason, names in work_calendar.upcoming(accounts):
+                who = "" if len(names) == len(accounts) else f" ({', '.join(names)})"
+                lines.append(f"• {day}: {reason}{who}")
+            await update.message.reply_text("\n".join(lines), parse_mode="HTML")
+        
+        else:
+            await update.message.reply_text(usage)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Fecha no válida: {e}\n\n{usage}")
+    except Exception as e:
+        logger.error(f"❌ Error en comando /vacation: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+async def handle_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja comando /history [N] [cuenta] para ver los últimos fichajes de las cuentas del chat"""
+    try:
+        accounts = _chat_accounts(update)
+        if not accounts:
+            await update.message.reply_text("ℹ️ Este chat no tiene cuentas asociadas")
+            return
+        limit = 10
+        for arg in context.args or []:
+            if arg.isdigit():
+                limit = min(int(arg), 50)
+            elif arg in accounts:
+                accounts = [arg]
+            else:
+                await update.message.reply_text(f"❌ La cuenta '{arg}' no es de este chat")
+                return
+        rows = await ledger.history(limit, accounts)
+        if not rows:
+            await update.message.reply_text("ℹ️ No hay fichajes registrados")
+            return
+        lines = []
+        for row in rows:
+            when = datetime.fromtimestamp(row["started_at"], TIMEZONE).strftime("%d/%m %H:%M")
+            line = f"{'✅' if row['ok'] else '❌'} {when} {row['action']} {row['account']} ({row['engine'] or '-'}, {row['duration']:.1f}s)"
+            if row["trigger"] != "schedule":
+                line += f" [{row['trigger']}]"
+            if row["error"]:
+                line += f"\n    <code>{html.escape(row['error'][:80])}</code>"
+                if row["run_id"]:
+                    line += f" <i>run {row['run_id']}</i>"
+            lines.append(line)
+        await update.message.reply_text(
+            f"<b>📜 Últimos {len(rows)} fichajes</b>\n\n" + "\n".join(lines), parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"❌ Error en comando /history: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+async def handle_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Maneja comando /status para ver estado del bot"""
+    try:
+        status = "▶️ ACTIVO" if bot_state["running"] else "⏸️ PAUSADO"
+        scheduler_status = "✅ Funcionando" if scheduler and scheduler.running else "❌ Detenido"
+        health = watchdog.health()
+        health_status = {"ok": "✅", "degraded": "⚠️", "fail": "❌"}[health["status"]]
+        today = ledger_day()
+        off_today = {name: reason for name in (a.name for a in roster) if (reason := work_calendar.day_off(name, today))}
+        if off_today:
+            days_off = f"Hoy: 🏖️ día libre ({', '.join(sorted({reason for _, reason in off_today.values()}))})"
+            if len(roster) > 1:
+                days_off += f" para {len(off_today)}/{len(roster)} cuentas"
+        else:
+            days_off = "Hoy: 💼 laborable"
+        days_off += f"\nFichajes omitidos por días libres: {work_calendar.skipped_total}"
+        for day, action, off in list(work_calendar.skipped)[-3:]:
+            reasons = ", ".join(sorted({reason for _, reason in off.values()}))
+            days_off += f"\n   • {day} {action}: {reasons} ({len(off)} cuenta(s))"
+        
+        await update.message.reply_text(
+            f"<b>Estado del Bot Bixpe</b>\n\n"
+            f"Estado general: {status}\n"
+            f"Scheduler: {scheduler_status}\n"
+            f"Cuentas: {len(roster)}\n"
+            f"Fichajes en curso: {len(inflight)}\n"
+            f"Salud: {health_status} {', '.join(health['failed'] + health['degraded']) or 'ok'} "
+            f"(retraso del loop {health['checks']['loop']['max_lag_1m'] * 1000:.0f} ms)\n"
+            f"{days_off}\n\n"
+            f"<b>Comandos disponibles:</b>\n"
+            f"/start - Reanudar bot\n"
+            f"/stop - Pausar bot\n"
+            f"/status - Ver estado\n"
+            f"/cancel - Cancelar fichajes en curso\n"
+            f"/history - Últimos fichajes\n"
+            f"/vacation - Festivos y vacaciones",
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"❌ Error en comando /status: {e}")
+        await update.message.reply_text(f"❌ Error: {html.escape(str(e))}", parse_mode="HTML")
+
+
+# Tareas en segundo plano (procesado de capturas) para que no las recoja el GC
+_background_tasks = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Lanza una corrutina en segundo plano guardando una referencia hasta que termine"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _encode_screenshot(data: bytes) -> bytes:
+    """Reescala y recodifica una captura con Pillow (se ejecuta en un hilo)"""
+    with Image.open(io.BytesIO(data)) as img:
+        if SCREENSHOT_MAX_WIDTH and img.width > SCREENSHOT_MAX_WIDTH:
+            height = round(img.height * SCREENSHOT_MAX_WIDTH / img.width)
+            img = img.resize((SCREENSHOT_MAX_WIDTH, height), Image.LANCZOS)
+        out = io.BytesIO()
+        if SCREENSHOT_FORMAT == "png":
+            img.save(out, format="PNG", optimize=True)
+        else:
+            img.convert("RGB").save(out, format="WEBP" if SCREENSHOT_FORMAT == "webp" else "JPEG", quality=SCREENSHOT_QUALITY)
+        return out.getvalue()
+
+
+async def capture_screenshot(page) -> bytes:
+    """Captura la página directamente a memoria, recortada a SCREENSHOT_SELECTOR si existe"""
+    options = {"scale": "css"}
+    if SCREENSHOT_FORMAT == "png":
+        options["type"] = "png"
+    else:
+        # Sin Pillow, WebP no es posible: Playwright genera JPEG directamente
+        options["type"] = "jpeg"
+        options["quality"] = 100 if load_pillow() is not None and SCREENSHOT_FORMAT == "webp" else SCREENSHOT_QUALITY
+    if SCREENSHOT_SELECTOR:
+        box = await page.locator(SCREENSHOT_SELECTOR).first.bounding_box()
+        if box:
+            options["clip"] = box
+    return await page.screenshot(**options)
+
+
+async def _process_and_enqueue(data: bytes, chat_id: str, caption: str) -> None:
+    """Reescala/recodifica la captura fuera del loop y la encola para Telegram"""
+    try:
+        if load_pillow() is not None:
+            with timed_step("screenshot_encode"):
+                data = await asyncio.to_thread(_encode_screenshot, data)
+        outbox.enqueue_photo(chat_id, data, caption=caption)
+        logger.info(f"📤 Captura encolada para Telegram ({len(data) // 1024} KB)")
+    except Exception as e:
+        logger.error(f"❌ Error al procesar captura: {e}")
+
+
+async def take_screenshot_and_send(page, event_name: str, chat_id: str = None) -> None:
+    """Toma una captura en memoria y la encola para Telegram.
+
+    Solo se espera a la captura en sí; el reescalado y el encolado siguen en
+    segundo plano mientras el flujo continúa con el siguiente paso.
+    """
+    chat_id = chat_id or TELEGRAM_CHAT_ID
+    if not telegram_bot or not chat_id:
+        logger.warning("⚠️ Telegram no configurado (ejecutando sin envío de capturas)")
+        return
+    
+    try:
+        with timed_step("screenshot"):
+            data = await capture_screenshot(page)
+        logger.info(f"📸 Captura tomada: {event_name}")
+        caption = f"🔔 {event_name}\nTiempo: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        _spawn(_process_and_enqueue(data, chat_id, caption))
+    except Exception as e:
+        logger.error(f"❌ Error al tomar captura: {e}")
+
+
+def _session_path(username: str) -> str:
+    """Ruta del fichero de sesión de un usuario (el nombre no expone el usuario)"""
+    digest = hashlib.sha256(username.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(SESSION_DIR, f"session_{digest}.json")
+
+
+def load_cached_session(username: str):
+    """Carga la sesión cacheada si existe y sus cookies no han caducado"""
+    if not SESSION_CACHE:
+        return None
+    try:
+        with open(_session_path(username), "r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Sesión cacheada ilegible, se ignora: {e}")
+        return None
+    
+    # Comprobación barata: si todas las cookies con caducidad ya expiraron no merece la pena probarla
+    cookies = cached.get("storage_state", {}).get("cookies", [])
+    expiring = [c.get("expires", -1) for c in cookies if c.get("expires", -1) > 0]
+    if not cookies or (expiring and len(expiring) == len(cookies) and max(expiring) < time.time()):
+        logger.info("⌛ Sesión cacheada caducada")
+        return None
+    return cached
+
+
+def save_cached_session(username: str, storage_state: dict, landing_url: str) -> None:
+    """Guarda la sesión de forma atómica y con permisos restringidos"""
+    if not SESSION_CACHE:
+        return
+    try:
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        path = _session_path(username)
+        tmp_path = f"{path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "landing_url": landing_url,
+                "saved_at": datetime.now().isoformat(),
+                "storage_state": storage_state
+            }, f)
+        os.replace(tmp_path, path)
+        logger.info("🍪 Sesión guardada en caché")
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo guardar la sesión: {e}")
+
+
+def clear_cached_session(username: str) -> None:
+    """Elimina la sesión cacheada de un usuario"""
+    try:
+        os.remove(_session_path(username))
+    except FileNotFoundError:
+        pass
+
+
+async def is_logged_in(page) -> bool:
+    """Indica si la página actual corresponde a una sesión autenticada"""
+    if page.url.split("?")[0].lower().startswith(LOGIN_URL.lower()):
+        return False
+    return await page.query_selector("input#Password") is None
+
+
+async def timed_wait(waits: dict, name: str, awaitable):
+    """Espera una señal concreta y anota en waits cuánto tardó (en segundos)"""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        waits[name] = round(time.perf_counter() - started, 3)
+
+
+def _left_login_page(url: str) -> bool:
+    return not url.split("?")[0].lower().startswith(LOGIN_URL.lower())
+
+
+async def open_session(page, username: str, cached=None, waits: dict = None) -> bool:
+    """Abre la sesión cacheada si sigue siendo válida; si no, deja la página en el formulario de login.
+
+    Devuelve True si se reutilizó la sesión cacheada.
+    """
+    waits = {} if waits is None else waits
+    if cached:
+        logger.info("🍪 Probando sesión cacheada...")
+        await timed_wait(waits, "session_check", page.goto(cached["landing_url"], wait_until="domcontentloaded"))
+        if await is_logged_in(page):
+            logger.info("✅ Sesión cacheada válida - login omitido")
+            return True
+        logger.info("⌛ Sesión cacheada caducada, haciendo login completo")
+        clear_cached_session(username)
+    
+    logger.info("🌐 Navegando a la página de login...")
+    if not page.url.lower().startswith(LOGIN_URL.lower()):
+        await page.goto(LOGIN_URL, wait_until="domcontentloaded")
+    return False
+
+
+async def submit_login(page, username: str, password: str, waits: dict = None) -> None:
+    """Rellena y envía el formulario de login y espera a salir de la página de login"""
+    waits = {} if waits is None else waits
+    await timed_wait(waits, "login_page", page.wait_for_selector(
+        "input#Username", state="visible", timeout=WAIT_TIMEOUTS["login_page"]
+    ))
+    
+    # Hacer login
+    logger.info("🔐 Ingresando credenciales...")
+    await page.fill("input#Username", username)
+    await page.fill("input#Password", password)
+    
+    # Hacer clic en el botón de login y esperar a salir de la página de login
+    logger.info("🔘 Haciendo clic en botón de login...")
+    await page.click("button[type='submit']")
+    try:
+        await timed_wait(waits, "post_login", page.wait_for_url(
+            _left_login_page, wait_until="domcontentloaded", timeout=WAIT_TIMEOUTS["post_login"]
+        ))
+    except PlaywrightTimeoutError:
+        raise RuntimeError("Login no completado - revisa usuario y contraseña")
+    logger.info("✅ Login completado")
+
+
+class ResourcePolicy:
+    """Intercepta las peticiones de un BrowserContext para no descargar lo que el bot no usa.
+
+    Bloquea por tipo de recurso y por patrón de URL (salvo lo que esté en la
+    lista de permitidos) y sirve CSS/JS desde una caché en disco entre ejecuciones.
+    La caché es compartida por todas las cuentas: no guarda respuestas privadas
+    (Cache-Control private/no-store/no-cache o Vary: Cookie) y respeta un
+    max-age menor que cache_ttl.
+    """
+
+    CACHEABLE_TYPES = ("stylesheet", "script")
+
+    def __init__(self, block_types: set, block_patterns: list, allow_patterns: list, cache_dir: str = None, cache_ttl: int = 0):
+        self.block_types = block_types
+        self.block_patterns = block_patterns
+        self.allow_patterns = allow_patterns
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+
+    @staticmethod
+    def _matches(url: str, patterns: list) -> bool:
+        return any(fnmatch.fnmatch(url, pattern) for pattern in patterns)
+
+    def _cache_paths(self, url: str) -> tuple:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, digest[:2], digest)
+        return f"{base}.json", f"{base}.body"
+
+    def _cache_lifetime(self, headers: dict) -> int:
+        """Segundos que se puede cachear una respuesta según sus cabeceras (0 = no cachear)"""
+        directives = {}
+        for part in headers.get("cache-control", "").lower().split(","):
+            name, _, value = part.strip().partition("=")
+            directives[name] = value.strip('"')
+        if directives.keys() & {"no-store", "no-cache", "private"}:
+            return 0
+        vary = {field.strip() for field in headers.get("vary", "").lower().split(",")}
+        if vary & {"cookie", "*"}:
+            return 0
+        try:
+            return max(0, min(self.cache_ttl, int(directives["max-age"])))
+        except (KeyError, ValueError):
+            return self.cache_ttl
+
+    def _cache_read(self, url: str):
+        meta_path, body_path = self._cache_paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if time.time() > meta.get("expires", os.path.getmtime(meta_path) + self.cache_ttl):
+                return None
+            with open(body_path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def _cache_write(self, url: str, status: int, headers: dict, body: bytes, lifetime: int) -> None:
+        meta_path, body_path = self._cache_paths(url)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(body_path, "wb") as f:
+            f.write(body)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"status": status, "headers": headers, "expires": time.time() + lifetime}, f)
+
+    async def apply(self, context, stats: dict) -> None:
+        """Instala la política en el contexto y va acumulando estadísticas en stats"""
+        for key in ("blocked", "cached", "bytes_saved"):
+            stats.setdefault(key, 0)
+
+        async def handle(route, request):
+            url = request.url
+            allowed = self._matches(url, self.allow_patterns)
+            if not allowed and (request.resource_type in self.block_types or self._matches(url, self.block_patterns)):
+                stats["blocked"] += 1
+                await route.abort("blockedbyclient")
+                return
+            if self.cache_dir and request.method == "GET" and request.resource_type in self.CACHEABLE_TYPES:
+                await self._serve_cached(route, url, stats)
+                return
+            await route.continue_()
+
+        await context.route("**/*", handle)
+
+    async def _serve_cached(self, route, url: str, stats: dict) -> None:
+        cached = await asyncio.to_thread(self._cache_read, url)
+        if cached is not None:
+            meta, body = cached
+            stats["cached"] += 1
+            stats["bytes_saved"] += len(body)
+            await route.fulfill(status=meta["status"], headers=meta["headers"], body=body)
+            return
+        
+        try:
+            response = await route.fetch()
+            body = await response.body()
+        except Exception as e:
+            # Sin respuesta que servir: la petición sigue su curso normal para no dejarla colgada
+            logger.debug(f"⚠️ No se pudo descargar {url} para la caché, se deja pasar: {e}")
+            try:
+                await route.continue_()
+            except Exception:
+                await route.abort()
+            return
+        lifetime = self._cache_lifetime({k.lower(): v for k, v in response.headers.items()})
+        if response.status == 200 and lifetime > 0:
+            headers = {k: v for k, v in response.headers.items() if k.lower() not in ("content-encoding", "content-length", "set-cookie")}
+            try:
+                await asyncio.to_thread(self._cache_write, url, response.status, headers, body, lifetime)
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo cachear {url}: {e}")
+        await route.fulfill(response=response, body=body)
+
+
+# Política compartida por todos los contextos
+resource_policy = ResourcePolicy(
+    BLOCK_RESOURCE_TYPES,
+    BLOCK_URL_PATTERNS,
+    ALLOW_URL_PATTERNS,
+    os.path.join(DATA_DIR, "assets") if ASSET_CACHE else None,
+    ASSET_CACHE_TTL
+)
+
+
+# Acciones de jornada: id del botón en la web, endpoint HTTP equivalente y textos de los avisos.
+# ACTIONS_FILE puede añadir otras (p. ej. una pausa para comer) sin tocar el código.
+WORKDAY_ACTIONS = {
+    "start": {
+        "button_id": "btn-start-workday", "url": BIXPE_START_URL,
+        "label": "MAÑANA", "emoji": "🌅", "done_emoji": "▶️", "summary": "Login y fichaje",
+    },
+    "stop": {
+        "button_id": "btn-stop-workday", "url": BIXPE_STOP_URL,
+        "label": "TARDE", "emoji": "🌆", "done_emoji": "⏹️", "summary": "Finalizar jornada",
+    },
+}
+
+
+def load_actions() -> list:
+    """Añade a WORKDAY_ACTIONS las acciones de ACTIONS_FILE y devuelve sus nombres.
+
+    Formato: objeto JSON {nombre: {button_id, url, label, emoji, done_emoji,
+    summary, at}}. Solo button_id es obligatorio; at es la hora por defecto
+    (cada cuenta puede cambiarla en su "schedule").
+    """
+    if not ACTIONS_FILE:
+        return []
+    with open(ACTIONS_FILE, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    for name, entry in entries.items():
+        if not entry.get("button_id"):
+            raise ValueError(f"Acción sin button_id en {ACTIONS_FILE}: {name}")
+        WORKDAY_ACTIONS[name] = {
+            "url": "", "label": name.upper(), "emoji": "🕒", "done_emoji": "✅", "summary": "",
+            **WORKDAY_ACTIONS.get(name, {}), **entry,
+        }
+    return list(entries)
+
+
+def account_time(account: Account, action: str) -> str:
+    """Hora HH:MM a la que una cuenta ejecuta una acción ("" si no la tiene programada)"""
+    if action == "start":
+        return account.morning
+    if action == "stop":
+        return account.afternoon
+    return account.schedule.get(action) or WORKDAY_ACTIONS[action].get("at", "")
+
+# Conector compartido por todas las sesiones HTTP (cada cuenta lleva su propio cookie jar)
+http_connector = None
+
+
+class UnexpectedMarkupError(Exception):
+    """La página no tiene el formato que espera el motor HTTP"""
+
+
+class _PageScanner(HTMLParser):
+    """Extrae formularios, campos y botones de una página HTML"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms = []
+        self.inputs = {}
+        self.buttons = {}
+        self._form = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: (v or "") for k, v in attrs}
+        if tag == "form":
+            self._form = {
+                "action": attrs.get("action", ""),
+                "method": attrs.get("method", "get").lower(),
+                "fields": {},
+                "has_password": False,
+            }
+            self.forms.append(self._form)
+        elif tag == "input" and attrs.get("name"):
+            self.inputs.setdefault(attrs["name"], attrs.get("value", ""))
+            if self._form is not None:
+                self._form["fields"][attrs["name"]] = attrs.get("value", "")
+                if attrs.get("type", "").lower() == "password":
+                    self._form["has_password"] = True
+        elif tag == "button" and attrs.get("id"):
+            attrs["form_action"] = self._form["action"] if self._form is not None else ""
+            attrs["form_method"] = self._form["method"] if self._form is not None else ""
+            self.buttons[attrs["id"]] = attrs
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+
+
+def _scan(html: str) -> _PageScanner:
+    scanner = _PageScanner()
+    scanner.feed(html)
+    return scanner
+
+
+def _get_http_connector():
+    """Crea (una sola vez) el pool de conexiones HTTP"""
+    global http_connector
+    if http_connector is None or http_connector.closed:
+        http_connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300)
+    return http_connector
+
+
+async def close_http_pool() -> None:
+    """Cierra el pool de conexiones HTTP"""
+    global http_connector
+    if http_connector is not None:
+        await http_connector.close()
+        http_connector = None
+
+
+def _cookies_to_jar(jar, storage_state: dict) -> None:
+    """Carga en el cookie jar las cookies de un storage_state de Playwright"""
+    for cookie in storage_state.get("cookies", []):
+        if 0 < cookie.get("expires", -1) < time.time():
+            continue
+        scheme = "https" if cookie.get("secure") else "http"
+        url = f"{scheme}://{cookie['domain'].lstrip('.')}{cookie.get('path', '/')}"
+        jar.update_cookies({cookie["name"]: cookie["value"]}, response_url=yarl.URL(url))
+
+
+def _jar_to_storage_state(jar, previous: dict = None) -> dict:
+    """Convierte el cookie jar en un storage_state compatible con Playwright"""
+    cookies = []
+    for morsel in jar:
+        expires = -1
+        if morsel["max-age"]:
+            expires = time.time() + int(morsel["max-age"])
+        elif morsel["expires"]:
+            try:
+                expires = parsedate_to_datetime(morsel["expires"]).timestamp()
+            except (TypeError, ValueError):
+                pass
+        cookies.append({
+            "name": morsel.key,
+            "value": morsel.value,
+            "domain": morsel["domain"],
+            "path": morsel["path"] or "/",
+            "expires": expires,
+            "httpOnly": bool(morsel["httponly"]),
+            "secure": bool(morsel["secure"]),
+            "sameSite": "Lax",
+        })
+    return {"cookies": cookies, "origins": (previous or {}).get("origins", [])}
+
+
+async def _http_login(session, username: str, password: str) -> tuple:
+    """Envía el formulario de login (con su token antiforgery) y devuelve (url, html) final"""
+    async with session.get(LOGIN_URL) as resp:
+        resp.raise_for_status()
+        login_url, html = str(resp.url), await resp.text()
+    
+    form = next((f for f in _scan(html).forms if f["has_password"]), None)
+    if form is None or "Username" not in form["fields"] or "Password" not in form["fields"]:
+        raise UnexpectedMarkupError("formulario de login no reconocido")
+    
+    data = dict(form["fields"])
+    data["Username"] = username
+    data["Password"] = password
+    async with session.post(urljoin(login_url, form["action"] or login_url), data=data) as resp:
+        resp.raise_for_status()
+        url, html = str(resp.url), await resp.text()
+    
+    # Respuestas OpenID Connect "form_post": formularios ocultos que el navegador enviaría solo
+    for _ in range(3):
+        scanner = _scan(html)
+        auto_form = next((f for f in scanner.forms if f["method"] == "post" and not f["has_password"] and f["fields"]), None)
+        if any(f["has_password"] for f in scanner.forms):
+            raise RuntimeError("Login rechazado - revisa usuario y contraseña")
+        if auto_form is None or any(spec["button_id"] in scanner.buttons for spec in WORKDAY_ACTIONS.values()):
+            break
+        async with session.post(urljoin(url, auto_form["action"] or url), data=auto_form["fields"]) as resp:
+            resp.raise_for_status()
+            url, html = str(resp.url), await resp.text()
+    
+    return url, html
+
+
+def _check_action_response(action: str, url: str, content_type: str, body: str) -> None:
+    """Exige prueba de que Bixpe registró la acción; si no, lanza RuntimeError.
+
+    Vale un JSON con success: true, o bien la página de jornada de vuelta (no
+    el login, sin formulario de contraseña y con sus botones). Una redirección
+    al login o la respuesta de un formulario ajeno no cuentan como fichaje.
+    No se recurre al navegador: la petición ya se envió y repetirla podría
+    fichar dos veces.
+    """
+    if "json" in content_type:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.get("success") is True:
+            return
+        message = data.get("message", data) if isinstance(data, dict) else body[:200]
+        raise RuntimeError(f"Bixpe no confirmó la acción '{action}': {message}")
+    if not _left_login_page(url):
+        raise RuntimeError(f"Bixpe no confirmó la acción '{action}': la sesión acabó en la página de login")
+    scanner = _scan(body)
+    if any(f["has_password"] for f in scanner.forms):
+        raise RuntimeError(f"Bixpe no confirmó la acción '{action}': la respuesta pide credenciales")
+    if not any(spec["button_id"] in scanner.buttons for spec in WORKDAY_ACTIONS.values()):
+        raise RuntimeError(f"Bixpe no confirmó la acción '{action}': respuesta no reconocida ({url})")
+
+
+async def http_clock_action(username: str, password: str, action: str, gate: ClickGate = None) -> float:
+    """Ejecuta el fichaje (start/stop) solo con HTTP y devuelve el instante (epoch) de la petición.
+
+    Lanza UnexpectedMarkupError si la web no tiene el aspecto esperado, para que
+    quien llame pueda recurrir al navegador. Con gate, la petición final espera
+    a la hora objetivo tras dejar la sesión y el token preparados.
+    """
+    spec = WORKDAY_ACTIONS[action]
+    cached = load_cached_session(username)
+    jar = aiohttp.CookieJar(unsafe=True)
+    if cached:
+        _cookies_to_jar(jar, cached["storage_state"])
+    
+    async with aiohttp.ClientSession(
+        connector=_get_http_connector(),
+        connector_owner=False,
+        cookie_jar=jar,
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+    ) as session:
+        url, html = "", ""
+        workday_url = BIXPE_WORKDAY_URL or (cached or {}).get("landing_url", "")
+        if workday_url:
+            async with session.get(workday_url) as resp:
+                resp.raise_for_status()
+                url, html = str(resp.url), await resp.text()
+        
+        if not html or any(f["has_password"] for f in _scan(html).forms):
+            logger.info("🔐 [HTTP] Haciendo login...")
+            url, html = await _http_login(session, username, password)
+            if BIXPE_WORKDAY_URL and url != BIXPE_WORKDAY_URL:
+                async with session.get(BIXPE_WORKDAY_URL) as resp:
+                    resp.raise_for_status()
+                    url, html = str(resp.url), await resp.text()
+        else:
+            logger.info("🍪 [HTTP] Sesión cacheada válida - login omitido")
+        
+        scanner = _scan(html)
+        button = scanner.buttons.get(spec["button_id"])
+        if button is None:
+            raise UnexpectedMarkupError(f"botón #{spec['button_id']} no encontrado")
+        endpoint = spec.get("url") or button.get("data-url") or button.get("formaction")
+        if not endpoint and button.get("form_method") == "post":
+            # Un formulario GET (búsqueda, filtros...) que envuelva el botón no es su acción
+            endpoint = button.get("form_action")
+        if not endpoint:
+            raise UnexpectedMarkupError(f"no se conoce el endpoint de #{spec['button_id']}")
+        
+        token = scanner.inputs.get("__RequestVerificationToken", "")
+        headers = {"X-Requested-With": "XMLHttpRequest"}
+        if token:
+            headers["RequestVerificationToken"] = token
+        
+        if gate is not None:
+            await gate.commit()
+        
+        # Equivale a pulsar el botón y confirmar el popup swal2
+        logger.info(f"🔘 [HTTP] Enviando acción '{action}'...")
+        clicked_at = time.time()
+        async with session.post(urljoin(url, endpoint), data={"__RequestVerificationToken": token}, headers=headers) as resp:
+            resp.raise_for_status()
+            _check_action_response(action, str(resp.url), resp.content_type, await resp.text())
+        
+        save_cached_session(username, _jar_to_storage_state(jar, (cached or {}).get("storage_state")), url)
+        return clicked_at
+
+
+async def try_http_clock_action(username: str, password: str, action: str, gate: ClickGate = None):
+    """Intenta el fichaje por HTTP si está activado.
+
+    Devuelve el instante (epoch) de la petición, o None si hay que usar el navegador.
+    """
+    if CLOCK_ENGINE != "http":
+        return None
+    started = time.perf_counter()
+    try:
+        clicked_at = await http_clock_action(username, password, action, gate)
+    except UnexpectedMarkupError as e:
+        metrics.inc("bixpe_steps_total", {"step": "http_engine", "result": "fallback"})
+        logger.warning(f"⚠️ Motor HTTP: {e} - usando navegador como respaldo")
+        return None
+    except BaseException:
+        metrics.inc("bixpe_steps_total", {"step": "http_engine", "result": "error"})
+        raise
+    
+    # La espera hasta la hora objetivo no cuenta como tiempo del motor
+    elapsed = time.perf_counter() - started - (gate.waited if gate else 0.0)
+    metrics.inc("bixpe_steps_total", {"step": "http_engine", "result": "ok"})
+    observe_step("http_engine", elapsed)
+    logger.info(f"⚡ Fichaje HTTP '{action}' completado en {elapsed:.2f}s")
+    return clicked_at
+
+
+
+def _workday_response_matcher(endpoint: str):
+    """Predicado de la respuesta del servidor a la acción: un POST a su endpoint.
+
+    Con endpoint vacío (el botón no lo indica) vale cualquier POST XHR/fetch o
+    envío de formulario, y entonces un sondeo de la página podría tomarse por
+    la respuesta; por eso se avisa y conviene configurar BIXPE_START_URL/STOP_URL.
+    """
+    target = urlparse(endpoint)
+
+    def predicate(response) -> bool:
+        request = response.request
+        if request.method != "POST":
+            return False
+        if not endpoint:
+            return request.resource_type in ("xhr", "fetch", "document")
+        url = urlparse(request.url)
+        return url.path.rstrip("/").lower() == target.path.rstrip("/").lower() and url.netloc == target.netloc
+
+    return predicate
+
+
+# Endpoint de la acción según el botón: data-url, formaction o la acción de su formulario POST
+_BUTTON_ENDPOINT_JS = """sel => {
+    const b = document.querySelector(sel);
+    if (!b) return "";
+    const form = b.form && b.form.method.toLowerCase() === "post" ? b.form.getAttribute("action") : "";
+    return b.getAttribute("data-url") || b.getAttribute("formaction") || form || "";
+}"""
+
+
+def scheduled_epoch(at: str) -> float:
+    """Epoch de hoy a la hora HH:MM de Madrid"""
+    hour, minute = (int(part) for part in at.split(":"))
+    return TIMEZONE.localize(
+        datetime.combine(datetime.now(TIMEZONE).date(), datetime.min.time().replace(hour=hour, minute=minute))
+    ).timestamp()
+
+
+async def clock_job(action: str, account_names: list, at: str, trigger: str = "schedule") -> None:
+    """Job de fichaje: corre en el loop con presupuesto de tiempo y se puede cancelar con /cancel.
+
+    Con trigger="catchup" la hora ya pasó: se ficha en el acto, sin dos fases.
+    """
+    if not bot_state["running"] or shutdown_event.is_set():
+        logger.warning(f"⏸️ Tarea '{action}' saltada - Bot pausado")
+        return
+    
+    # Lo ya fichado hoy (según el registro) no se repite, p. ej. tras un reinicio
+    day = ledger_day()
+    done = [name for name in account_names if ledger.is_done(name, day, action)]
+    if done:
+        logger.info(f"✔️ '{action}' ya registrado hoy, se omite: {', '.join(done)}")
+    
+    # Festivos y vacaciones (índice precalculado): esas cuentas no lanzan navegador ni hacen login
+    off = {name: reason for name in account_names if (reason := work_calendar.day_off(name, day))}
+    if off:
+        work_calendar.record_skip(day, action, off)
+        reasons = sorted({reason for _, reason in off.values()})
+        logger.info(f"🏖️ '{action}' omitido por día libre ({', '.join(reasons)}): {', '.join(off)}")
+    
+    # Una cuenta nunca ficha dos veces a la vez aunque se solapen jobs
+    busy = {name for _, names in inflight.values() for name in names}
+    accounts = [a for a in roster if a.name in account_names and a.name not in busy and a.name not in done and a.name not in off]
+    skipped = [name for name in account_names if name in busy]
+    if skipped:
+        logger.warning(f"⚠️ Cuentas con un fichaje aún en curso, se omiten: {', '.join(skipped)}")
+    if not accounts:
+        return
+    
+    catchup = trigger == "catchup"
+    scheduled_at = None if catchup else scheduled_epoch(at)
+    # El presupuesto cuenta desde la hora del clic: la espera previa no consume tiempo de fichaje
+    budget = (0.0 if catchup else max(0.0, scheduled_at - time.time())) + JOB_TIMEOUT
+    
+    task = asyncio.current_task()
+    inflight[task] = (action, [a.name for a in accounts])
+    metrics.set("bixpe_jobs_inflight", len(inflight))
+    try:
+        await asyncio.wait_for(
+            run_for_accounts(action, accounts, scheduled_at, TWO_PHASE_SCHEDULING and not catchup, trigger), budget
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"⏱️ Tarea '{action}' ({at}) abortada: superó {budget:.0f}s")
+        metrics.inc("bixpe_jobs_aborted_total", {"action": action, "reason": "timeout"})
+        await send_telegram_notification(
+            f"⏱️ <b>Tarea '{action}' ({at}) abortada</b> tras {budget:.0f}s sin terminar", is_error=True
+        )
+        await _abort_browser_if_idle(task)
+    except asyncio.CancelledError:
+        logger.warning(f"🛑 Tarea '{action}' ({at}) cancelada")
+        metrics.inc("bixpe_jobs_aborted_total", {"action": action, "reason": "cancelled"})
+        await send_telegram_notification(f"🛑 <b>Tarea '{action}' ({at}) cancelada</b>", is_error=True)
+        await _abort_browser_if_idle(task)
+    finally:
+        inflight.pop(task, None)
+        metrics.set("bixpe_jobs_inflight", len(inflight))
+
+
+async def _abort_browser_if_idle(task: asyncio.Task) -> None:
+    """Tras abortar un job, cierra el navegador si ningún otro lo está usando"""
+    if not any(other is not task for other in inflight):
+        await browser_manager.abort()
+
+
+def _is_workday(days: str, day) -> bool:
+    """Indica si la expresión cron de días (p. ej. mon-fri) incluye la fecha dada"""
+    midnight = TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+    next_fire = CronTrigger(day_of_week=days, timezone=TIMEZONE).get_next_fire_time(None, midnight)
+    return next_fire is not None and next_fire.date() == day
+
+
+def fire_epoch(at: str) -> float:
+    """Epoch de hoy en que se dispara el job de la hora HH:MM (antes si hay dos fases)"""
+    return scheduled_epoch(at) - (PRECLICK_MAX_LEAD if TWO_PHASE_SCHEDULING else 0)
+
+
+async def catch_up() -> None:
+    """Al arrancar, ejecuta las acciones de hoy cuyo job ya debió dispararse y no constan en el registro.
+
+    Solo se recupera la última acción pendiente con sentido: el start si aún
+    no es hora del stop, y el stop solo si el start de hoy se hizo. Con la
+    jornada abierta, de las acciones de ACTIONS_FILE se recupera solo la más
+    reciente cuya hora ya llegó (p. ej. la vuelta de la pausa). Si el job
+    ya debía haber arrancado pero la hora del clic no ha llegado (reinicio
+    durante la preparación en dos fases), se lanza como un job normal y el
+    clic sigue siendo a su hora.
+    """
+    now = datetime.now(TIMEZONE)
+    day = ledger_day()
+    groups = {}
+    for account in roster:
+        if not _is_workday(account.days, now.date()) or work_calendar.day_off(account.name, day):
+            continue
+        started = ledger.is_done(account.name, day, "start")
+        if now.timestamp() >= fire_epoch(account.afternoon):
+            if started and not ledger.is_done(account.name, day, "stop"):
+                groups.setdefault(("stop", account.afternoon), []).append(account.name)
+            elif not started:
+                logger.warning(f"⚠️ Sin fichaje de entrada hoy y ya pasó la salida, no se recupera{_account_tag(account)}")
+        elif now.timestamp() >= fire_epoch(account.morning) and not started:
+            groups.setdefault(("start", account.morning), []).append(account.name)
+        elif started:
+            due = [
+                (at, action) for action in WORKDAY_ACTIONS
+                if action not in ("start", "stop") and (at := account_time(account, action)) and now.timestamp() >= fire_epoch(at)
+            ]
+            if due:
+                at, action = max(due)
+                if not ledger.is_done(account.name, day, action):
+                    groups.setdefault((action, at), []).append(account.name)
+    
+    for (action, at), names in sorted(groups.items()):
+        if now.timestamp() < scheduled_epoch(at):
+            logger.info(f"🔁 Reanudando '{action}' de las {at} (el job ya debía estar preparándose) para: {', '.join(names)}")
+            _spawn(clock_job(action, names, at))
+            continue
+        logger.info(f"🔁 Recuperando '{action}' de las {at} para: {', '.join(names)}")
+        await send_telegram_notification(f"🔁 <b>Recuperando '{action}' de las {at}</b> perdido ({len(names)} cuenta(s))")
+        _spawn(clock_job(action, names, at, trigger="catchup"))
+
+
+def cancel_inflight(action: str = None, accounts: list = None) -> int:
+    """Cancela los fichajes en curso (todos o los de una acción) y devuelve cuántos.
+
+    Con accounts solo se cancelan los jobs cuyas cuentas están todas en esa lista.
+    """
+    tasks = [
+        task for task, (job_action, names) in inflight.items()
+        if action in (None, job_action) and (accounts is None or set(names) <= set(accounts))
+    ]
+    for task in tasks:
+        task.cancel()
+    return len(tasks)
+
+
+async def drain_inflight(timeout: float) -> None:
+    """Espera a que terminen los fichajes en curso y cancela los que sigan tras `timeout` segundos"""
+    if not inflight:
+        return
+    logger.info(f"⏳ Esperando a {len(inflight)} fichaje(s) en curso (máx. {timeout:.0f}s)...")
+    _, pending = await asyncio.wait(list(inflight), timeout=timeout)
+    if pending:
+        logger.warning(f"🛑 Cancelando {len(pending)} fichaje(s) que no terminaron a tiempo")
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=15)
+
+
+@dataclass
+class Step:
+    """Paso declarativo del flujo del navegador.
+
+    selector admite {button} (el botón de la acción) y timeout es una clave de
+    WAIT_TIMEOUTS. Si el paso falla con un error de retry_on se reintenta sobre
+    la misma página: antes se llama a recover (dejar la página lista) y se
+    comprueba done, el punto de recuperación que evita repetir un efecto que
+    ya se produjo (p. ej. un clic que llegó al servidor). Un paso optional que
+    falla solo genera un aviso.
+    """
+    name: str
+    run: object  # async (FlowRun, Step) -> None
+    selector: str = ""
+    timeout: str = ""
+    caption: str = ""
+    retries: int = 0
+    retry_on: tuple = ()  # Vacío = errores de Playwright (se importa al primer uso)
+    retry_delay: float = 1.0
+    optional: bool = False
+    done: object = None  # async (FlowRun) -> bool
+    recover: object = None  # async (FlowRun) -> None
+
+
+@dataclass
+class FlowRun:
+    """Estado de una acción en el navegador compartido por los pasos del flujo"""
+    account: Account
+    action: str
+    page: object
+    result: RunResult
+    gate: ClickGate
+    at: str = ""
+    tag: str = ""
+    cached: dict = None
+    session_reused: bool = False
+    response: object = None  # Futuro con la respuesta del servidor a la acción (se arma antes del clic)
+    click_started: float = 0.0
+
+    @property
+    def spec(self) -> dict:
+        return WORKDAY_ACTIONS[self.action]
+
+    def selector(self, step: Step) -> str:
+        return step.selector.format(button=f"button#{self.spec['button_id']}")
+
+    def timeout(self, step: Step) -> int:
+        return WAIT_TIMEOUTS[step.timeout]
+
+    def caption(self, step: Step) -> str:
+        # Las acciones de ACTIONS_FILE pueden traer su propio "at": manda la hora de esta ejecución
+        return step.caption.format_map({**self.spec, "at": self.at, "tag": self.tag, "action": self.action.upper()})
+
+    def discard_response(self) -> None:
+        """Cancela (o da por leída) la espera de respuesta para que no quede colgando"""
+        if self.response is not None:
+            if not self.response.done():
+                self.response.cancel()
+            elif not self.response.cancelled():
+                self.response.exception()
+
+
+async def _step_open_session(run: FlowRun, step: Step) -> None:
+    run.session_reused = await open_session(run.page, run.account.username, run.cached, run.result.waits)
+
+
+async def _step_login(run: FlowRun, step: Step) -> None:
+    if not run.session_reused:
+        await submit_login(run.page, run.account.username, run.account.password, run.result.waits)
+    if await is_logged_in(run.page):
+        save_cached_session(run.account.username, await run.page.context.storage_state(), run.page.url)
+    else:
+        logger.warning("⚠️ Sigue mostrándose el formulario de login - sesión no cacheada")
+
+
+async def _step_wait_visible(run: FlowRun, step: Step) -> None:
+    await timed_wait(run.result.waits, step.name, run.page.wait_for_selector(
+        run.selector(step), state="visible", timeout=run.timeout(step)
+    ))
+
+
+async def _step_wait_hidden(run: FlowRun, step: Step) -> None:
+    await timed_wait(run.result.waits, step.name, run.page.wait_for_selector(
+        run.selector(step), state="hidden", timeout=run.timeout(step)
+    ))
+
+
+async def _step_screenshot(run: FlowRun, step: Step) -> None:
+    await take_screenshot_and_send(run.page, run.caption(step), chat_id=run.account.chat_id)
+
+
+async def _step_click(run: FlowRun, step: Step) -> None:
+    # Esperar a la hora objetivo (dos fases) con la página ya lista
+    await run.gate.commit()
+    selector = run.selector(step)
+    await timed_wait(run.result.waits, "workday_enabled", run.page.wait_for_function(
+        "sel => { const b = document.querySelector(sel); return !!b && !b.disabled; }",
+        arg=selector, timeout=run.timeout(step)
+    ))
+    # La espera de la respuesta se arma antes del clic para no perderla, ligada al endpoint de la acción
+    if run.response is None:
+        endpoint = run.spec.get("url") or await run.page.evaluate(_BUTTON_ENDPOINT_JS, selector)
+        endpoint = urljoin(run.page.url, endpoint) if endpoint else ""
+        if not endpoint:
+            logger.warning(f"⚠️ El botón de '{run.action}' no indica su endpoint: se aceptará cualquier POST como respuesta")
+        run.response = asyncio.ensure_future(run.page.wait_for_event(
+            "response", predicate=_workday_response_matcher(endpoint), timeout=WAIT_TIMEOUTS["server_response"]
+        ))
+        await asyncio.sleep(0)  # Deja que registre el listener antes de pulsar
+    logger.info(f"🔍 Pulsando botón de {run.action.upper()}...")
+    run.click_started = time.perf_counter()
+    await run.page.click(selector)
+    run.result.clicked_at = time.time()
+    logger.info(f"🔘 Botón {selector} clickeado")
+
+
+async def _step_confirm(run: FlowRun, step: Step) -> None:
+    logger.info("⏳ Esperando popup de confirmación...")
+    confirm_button = await timed_wait(run.result.waits, "popup_open", run.page.wait_for_selector(
+        run.selector(step), state="visible", timeout=run.timeout(step)
+    ))
+    await confirm_button.click()
+    logger.info("✅ Popup confirmado")
+
+
+async def _step_server_response(run: FlowRun, step: Step) -> None:
+    response = await run.response
+    run.result.waits["server_response"] = round(time.perf_counter() - run.click_started, 3)
+    if not response.ok:
+        raise RuntimeError(f"El servidor respondió {response.status} a la acción '{run.action}'")
+    logger.info(f"📨 Respuesta del servidor: {response.status}")
+    logger.info(f"{run.spec['done_emoji']} Botón {run.action.upper()} y confirmación completados")
+
+
+async def _clicked(run: FlowRun) -> bool:
+    """El clic ya se hizo: repetirlo ficharía dos veces"""
+    return bool(run.result.clicked_at)
+
+
+async def _response_received(run: FlowRun) -> bool:
+    """El servidor ya respondió a la acción, así que el popup ya no hace falta"""
+    response = run.response
+    return response is not None and response.done() and not response.cancelled() and response.exception() is None
+
+
+async def _logged_in(run: FlowRun) -> bool:
+    return await is_logged_in(run.page)
+
+
+async def _reload_page(run: FlowRun) -> None:
+    await run.page.reload(wait_until="domcontentloaded")
+
+
+async def _back_to_login(run: FlowRun) -> None:
+    run.session_reused = False
+    await run.page.goto(LOGIN_URL, wait_until="domcontentloaded")
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
 
-# Configuración desde variables de entorno
-LOGIN_URL = "https://auth2.bixpe.com/Account/Login"
-USERNAME = os.getenv("BIXPE_USERNAME", "tu_usuario")
-PASSWORD = os.getenv("BIXPE_PASSWORD", "tu_contraseña")
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
-TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
-BUTTON_SELECTOR = os.getenv("BUTTON_SELECTOR", "button[type='submit']")  # Ajusta según la web
-HEADLESS = os.getenv("HEADLESS", "false").lower() == "true"
+# Flujo del navegador, común a todas las acciones de WORKDAY_ACTIONS
+BROWSER_FLOW = (
+    Step("session", _step_open_session, retries=1),
+    Step("login", _step_login, retries=1, done=_logged_in, recover=_back_to_login),
+    Step("workday_ready", _step_wait_visible, selector="{button}", timeout="workday_ready", retries=1,
+         recover=_reload_page),
+    Step("screenshot_login", _step_screenshot, caption="✅ Login Exitoso - TAREA {label} ({at}){tag}", optional=True),
+    Step("click", _step_click, selector="{button}", timeout="workday_ready", retries=1, done=_clicked),
+    Step("confirm", _step_confirm, selector="button.swal2-confirm.swal2-styled", timeout="popup_open", retries=1,
+         optional=True, done=_response_received),
+    Step("server_response", _step_server_response),
+    Step("popup_close", _step_wait_hidden, selector=".swal2-container", timeout="popup_close", optional=True),
+    Step("screenshot_done", _step_screenshot, caption="{done_emoji} Botón {action} y confirmación completados ({at}){tag}",
+         optional=True),
+)
 
-# Configuración del pool de conexiones
-TELEGRAM_POOL_SIZE = 5
-TELEGRAM_POOL_TIMEOUT = 10
 
-# Instancia del bot de Telegram (se inicializa en main usando la Application)
-telegram_bot = None
+async def execute_flow(run: FlowRun, steps) -> None:
+    """Ejecuta los pasos en orden, reintentando solo el que falla sobre la página viva"""
+    for step in steps:
+        attempt = 0
+        while True:
+            try:
+                if attempt and step.done is not None and await step.done(run):
+                    logger.info(f"✔️ Paso '{step.name}' ya completado, no se repite")
+                    break
+                with timed_step(step.name):
+                    await step.run(run, step)
+                break
+            except Exception as e:
+                if isinstance(e, step.retry_on or (PlaywrightError,)) and attempt < step.retries:
+                    attempt += 1
+                    metrics.inc("bixpe_step_retries_total", {"step": step.name})
+                    logger.warning(f"🔁 Paso '{step.name}' falló ({e}), reintento {attempt}/{step.retries}")
+                    await asyncio.sleep(step.retry_delay)
+                    if step.recover is not None:
+                        try:
+                            await step.recover(run)
+                        except PlaywrightError as recover_error:
+                            logger.warning(f"⚠️ No se pudo preparar el reintento de '{step.name}': {recover_error}")
+                    continue
+                if step.optional:
+                    logger.warning(f"⚠️ Paso '{step.name}' sin completar ({e}), continuando...")
+                    break
+                if isinstance(e, PlaywrightError):
+                    raise RuntimeError(f"Paso '{step.name}' falló: {e}") from e
+                raise
 
-# Scheduler global (AsyncIOScheduler en lugar de BackgroundScheduler)
-scheduler = None
 
-# Loop global
-event_loop = None
+async def clock_task(account: Account, action: str, gate: ClickGate = None) -> RunResult:
+    """Ejecuta una acción de jornada para una cuenta: por HTTP o, si no, con el flujo del navegador"""
+    spec = WORKDAY_ACTIONS[action]
+    label = spec["label"]
+    at = account_time(account, action)
+    result = RunResult(account=account.name, action=action)
+    started = time.perf_counter()
+    tag = _account_tag(account)
+    gate = gate or ClickGate()
+    try:
+        logger.info("=" * 50)
+        logger.info(f"{spec['emoji']} INICIANDO TAREA DE {label} ({at}){tag}")
+        logger.info("=" * 50)
+        summary = f" - {spec['summary']}" if spec["summary"] else ""
+        await send_telegram_notification(f"{spec['emoji']} Iniciando tarea de {label} ({at}){tag}{summary}", chat_id=account.chat_id)
 
-# Estado del bot
-bot_state = {
-    "running": True,
-    "app": None
-}
+        async with gate:
+            result.engine = "http"
+            result.clicked_at = await try_http_clock_action(account.username, account.password, action, gate) or 0.0
+            if not result.clicked_at:
+                result.engine = "browser"
+                browser_flow = run_browser_worker if BROWSER_WORKER else run_browser_flow
+                await browser_flow(account, action, result, gate, at, tag)
 
-async def send_telegram_notification(message: str, is_error: bool = False) -> None:
-    """Envía notificación por Telegram con reintentos"""
-    if not telegram_bot or not TELEGRAM_CHAT_ID:
-        logger.warning("⚠️ Telegram no configurado")
-        return
-    
-    max_retries = 3
-    for attempt in range(max_retries):
+        result.ok = True
+        result.click_error = gate.error(result.clicked_at)
+        if result.click_error is not None:
+            logger.info(f"🎯 Clic a {result.click_error:+.3f}s de la hora objetivo{tag}")
+        logger.info(f"🏁 TAREA DE {label} COMPLETADA{tag}\n")
+        await send_telegram_notification(f"✅ Tarea de {label} completada exitosamente{tag}", is_error=False, chat_id=account.chat_id)
+
+    except Exception as e:
+        result.error = str(e) or type(e).__name__
+        logger.error(f"❌ Error en tarea de {label.lower()}{tag}: {e}", exc_info=True)
+        await send_telegram_notification(f"<b>❌ ERROR en tarea {label}{tag}:</b>\n<code>{html.escape(str(e))}</code>", is_error=True, chat_id=account.chat_id)
+    result.duration = time.perf_counter() - started - gate.waited
+    if result.waits:
+        logger.info("⏱️ Esperas: " + ", ".join(f"{name}={secs:.2f}s" for name, secs in result.waits.items()))
+    if result.network:
+        logger.info(
+            f"🚫 Peticiones evitadas: {result.network['blocked']} bloqueadas, {result.network['cached']} desde caché "
+            f"({result.network['bytes_saved'] // 1024} KB ahorrados)"
+        )
+    return result
+
+
+async def run_browser_flow(account: Account, action: str, result: RunResult, gate: ClickGate, at: str, tag: str) -> None:
+    """Flujo del navegador de una acción en este proceso (contexto nuevo del navegador compartido)"""
+    cached = load_cached_session(account.username)
+    async with browser_manager.new_context(
+        storage_state=cached["storage_state"] if cached else None
+    ) as context:
+        await resource_policy.apply(context, result.network)
+        run = FlowRun(account, action, await context.new_page(), result, gate, at, tag, cached)
         try:
-            emoji = "❌" if is_error else "✅"
-            full_message = f"{emoji} {message}\n\n⏰ {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            await telegram_bot.send_message(
-                chat_id=TELEGRAM_CHAT_ID,
-                text=full_message,
-                parse_mode="HTML"
-            )
-            logger.info(f"📱 Notificación enviada por Telegram")
-            return
-        except Exception as e:
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # Backoff exponencial: 1s, 2s, 4s
-                logger.warning(f"⚠️ Intento {attempt + 1} fallido al enviar notificación, reintentando en {wait_time}s: {e}")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error(f"❌ Error al enviar notificación Telegram (después de {max_retries} intentos): {e}")
+            await execute_flow(run, BROWSER_FLOW)
+        finally:
+            run.discard_response()
 
 
-async def handle_start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Maneja comando /start para reanudar el bot"""
-    global scheduler, bot_state
-    
-    try:
-        if not bot_state["running"]:
-            bot_state["running"] = True
-            if scheduler and not scheduler.running:
-                scheduler.start()
-            
-            logger.info("▶️ BOT REANUDADO POR COMANDO TELEGRAM")
-            await update.message.reply_text(
-                "▶️ <b>Bot reanudado</b>\n\n"
-                "Las tareas se ejecutarán de Lunes a Viernes:\n"
-                "• 09:00 - Login + Fichaje\n"
-                "• 18:00 - Finalizar jornada",
-                parse_mode="HTML"
-            )
-            await send_telegram_notification("▶️ <b>Bot REANUDADO</b> - Tareas programadas activas (L-V)")
-        else:
-            await update.message.reply_text(
-                "✅ Bot ya está <b>activo</b>\n\n"
-                "Próximas tareas (Lunes a Viernes):\n"
-                "• 09:00 - Login + Fichaje\n"
-                "• 18:00 - Finalizar jornada",
-                parse_mode="HTML"
-            )
-    except Exception as e:
-        logger.error(f"❌ Error en comando /start: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}", parse_mode="HTML")
+class _WorkerPipe:
+    """Canal del subproceso del navegador hacia el padre: un objeto JSON por línea"""
 
-async def handle_stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Maneja comando /stop para pausar el bot"""
-    global scheduler
-    
-    try:
-        if bot_state["running"]:
-            bot_state["running"] = False
-            if scheduler and scheduler.running:
-                scheduler.pause()
-            
-            logger.info("⏸️ BOT PAUSADO POR COMANDO TELEGRAM")
-            await update.message.reply_text(
-                "⏸️ <b>Bot pausado</b>\n\n"
-                "Las tareas programadas están pausadas.\n"
-                "Usa /start para reanudar.",
-                parse_mode="HTML"
-            )
-            await send_telegram_notification("⏸️ <b>Bot PAUSADO</b> - Las tareas están suspendidas")
-        else:
-            await update.message.reply_text(
-                "⏸️ Bot ya está <b>pausado</b>\n\n"
-                "Usa /start para reanudar.",
-                parse_mode="HTML"
-            )
-    except Exception as e:
-        logger.error(f"❌ Error en comando /stop: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}", parse_mode="HTML")
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()  # Los logs pueden llegar desde otros hilos
 
-async def handle_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Maneja comando /status para ver estado del bot"""
+    def send(self, event: dict) -> None:
+        line = json.dumps(event, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+
+
+class _PipeLogHandler(logging.Handler):
+    """En el subproceso: reenvía los registros al padre, que los escribe con el contexto del fichaje"""
+
+    def __init__(self, pipe: _WorkerPipe):
+        super().__init__()
+        self.pipe = pipe
+
+    def emit(self, record) -> None:
+        try:
+            msg = record.getMessage()
+            if record.exc_info:
+                msg += "\n" + (self.formatter or logging.Formatter()).formatException(record.exc_info)
+            fields = {key: getattr(record, key) for key in JsonLogFormatter.FIELDS if getattr(record, key, None) is not None}
+            self.pipe.send({"event": "log", "record": {
+                **_log_context.get(), **fields,
+                "name": "worker" if record.name == logger.name else record.name,
+                "levelno": record.levelno, "levelname": record.levelname, "msg": msg, "created": record.created,
+            }})
+        except Exception:
+            self.handleError(record)
+
+
+class _ParentOutbox:
+    """En el subproceso: lo que habría que enviar a Telegram se entrega al outbox del padre"""
+
+    def __init__(self, pipe: _WorkerPipe):
+        self.pipe = pipe
+
+    def enqueue_message(self, chat_id: str, text: str) -> None:
+        self.pipe.send({"event": "message", "chat_id": chat_id, "text": text})
+
+    def enqueue_photo(self, chat_id: str, photo: bytes, caption: str = "") -> None:
+        self.pipe.send({"event": "photo", "chat_id": chat_id, "caption": caption, "photo": base64.b64encode(photo).decode("ascii")})
+
+
+class _WorkerGate(ClickGate):
+    """ClickGate del subproceso: al terminar la preparación avisa al padre para que libere su hueco"""
+
+    def __init__(self, pipe: _WorkerPipe, target: float = None):
+        super().__init__(target)
+        self.pipe = pipe
+
+    def mark_prepared(self, at: float = None) -> None:
+        if self.prepared_at is None:
+            super().mark_prepared(at)
+            self.pipe.send({"event": "prepared", "at": self.prepared_at})
+
+
+async def run_browser_worker(account: Account, action: str, result: RunResult, gate: ClickGate, at: str, tag: str) -> None:
+    """Flujo del navegador en un subproceso efímero (BROWSER_WORKER).
+
+    El subproceso importa Playwright, lanza su propio Chromium, ejecuta la
+    acción y termina, así que el bot en reposo no guarda nada del navegador y
+    un fallo o fuga de Chromium no le afecta. Por stdout llegan sus logs, las
+    capturas para Telegram, el aviso de preparación terminada (dos fases) y un
+    resultado compacto. Si la tarea se cancela, el subproceso se mata.
+    """
+    job = {
+        "account": asdict(account),  # Por stdin: la contraseña no aparece en argv ni en el entorno
+        "action": action,
+        "at": at,
+        "tag": tag,
+        "target": gate.target,
+        "telegram": bool(telegram_bot),
+        "log_level": logger.getEffectiveLevel(),
+    }
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--browser-worker",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        env={**os.environ, "LOG_FILE": ""},  # Solo el padre escribe (y rota) el fichero de logs
+        limit=BROWSER_WORKER_PIPE_LIMIT
+    )
+    logger.info(f"🧱 Navegador en subproceso (pid {proc.pid})")
+    outcome = None
     try:
-        status = "▶️ ACTIVO" if bot_state["running"] else "⏸️ PAUSADO"
-        scheduler_status = "✅ Funcionando" if scheduler and scheduler.running else "❌ Detenido"
-        
-        await update.message.reply_text(
-            f"<b>Estado del Bot Bixpe</b>\n\n"
-            f"Estado general: {status}\n"
-            f"Scheduler: {scheduler_status}\n\n"
-            f"<b>Comandos disponibles:</b>\n"
-            f"/start - Reanudar bot\n"
-            f"/stop - Pausar bot\n"
-            f"/status - Ver estado",
-            parse_mode="HTML"
-        )
-    except Exception as e:
-        logger.error(f"❌ Error en comando /status: {e}")
-        await update.message.reply_text(f"❌ Error: {str(e)}", parse_mode="HTML")
+        proc.stdin.write(json.dumps(job).encode("utf-8") + b"\n")
+        await proc.stdin.drain()
+        proc.stdin.close()
+        while line := await proc.stdout.readline():
+            event = json.loads(line)
+            kind = event["event"]
+            if kind == "log":
+                logger.handle(logging.makeLogRecord(event["record"]))
+            elif kind == "prepared":
+                gate.mark_prepared(event["at"])
+            elif kind == "message":
+                outbox.enqueue_message(event["chat_id"], event["text"])
+            elif kind == "photo":
+                outbox.enqueue_photo(event["chat_id"], base64.b64decode(event["photo"]), caption=event["caption"])
+            elif kind == "result":
+                outcome = event
+        await proc.wait()
+    finally:
+        if proc.returncode is None:
+            # Cancelado o timeout: matar el subproceso cierra también su driver y su Chromium
+            proc.kill()
+            await proc.wait()
+
+    if outcome is None:
+        metrics.inc("bixpe_browser_workers_total", {"result": "crash"})
+        raise RuntimeError(f"El proceso del navegador terminó sin resultado (código {proc.returncode})")
+    metrics.inc("bixpe_browser_workers_total", {"result": "error" if outcome["error"] else "ok"})
+    metrics.merge(outcome["metrics"])
+    steps = _run_steps.get()
+    if steps is not None:
+        for step, seconds in outcome["steps"].items():
+            steps[step] = round(steps.get(step, 0.0) + seconds, 4)
+    gate.waited += outcome["waited"]
+    result.clicked_at = outcome["clicked_at"]
+    result.waits.update(outcome["waits"])
+    result.network.update(outcome["network"])
+    if outcome["error"]:
+        raise RuntimeError(outcome["error"])
+
 
+async def browser_worker_main() -> int:
+    """Punto de entrada del subproceso del navegador: lee el trabajo por stdin y responde por stdout"""
+    global outbox, telegram_bot
+    # El protocolo usa el stdout original; cualquier print accidental va a stderr
+    pipe = _WorkerPipe(os.fdopen(os.dup(1), "wb"))
+    os.dup2(2, 1)
+    setup_logging(_PipeLogHandler(pipe))
 
-async def take_screenshot_and_send(page, event_name: str) -> None:
-    """Toma una captura de pantalla y la envía por Telegram"""
+    job = json.loads(sys.stdin.readline())
+    logger.setLevel(job["log_level"])
+    load_actions()
+    outbox = _ParentOutbox(pipe)
+    telegram_bot = outbox if job["telegram"] else None  # Solo se comprueba que Telegram esté configurado
+
+    account = Account(**job["account"])
+    result = RunResult(account=account.name, action=job["action"], engine="browser")
+    gate = _WorkerGate(pipe, job["target"])
+    steps = {}
+    _run_steps.set(steps)
+    error = ""
     try:
-        import tempfile
-        import platform
-        
-        # Crear ruta según el SO
-        if platform.system() == "Windows":
-            screenshot_path = os.path.join(tempfile.gettempdir(), f"screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png")
-        else:
-            screenshot_path = f"/tmp/screenshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        
-        await page.screenshot(path=screenshot_path)
-        logger.info(f"📸 Captura guardada: {screenshot_path}")
-        
-        if telegram_bot and TELEGRAM_CHAT_ID:
-            try:
-                with open(screenshot_path, 'rb') as photo:
-                    await telegram_bot.send_photo(
-                        chat_id=TELEGRAM_CHAT_ID,
-                        photo=photo,
-                        caption=f"🔔 {event_name}\nTiempo: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                    )
-                logger.info(f"✅ Captura enviada por Telegram: {event_name}")
-            except Exception as tg_error:
-                logger.error(f"❌ Error al enviar a Telegram: {tg_error}")
-        else:
-            if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-                logger.warning("⚠️ Telegram no configurado (ejecutando sin envío de capturas)")
-            
-        # Eliminar archivo temporal
-        if os.path.exists(screenshot_path):
-            os.remove(screenshot_path)
-            
+        await run_browser_flow(account, job["action"], result, gate, job["at"], job["tag"])
     except Exception as e:
-        logger.error(f"❌ Error al tomar captura: {e}")
+        error = str(e) or type(e).__name__
+    finally:
+        await browser_manager.close()
+        # Capturas aún en proceso de reescalado: que lleguen al padre antes de salir
+        if _background_tasks:
+            await asyncio.gather(*_background_tasks, return_exceptions=True)
+    pipe.send({
+        "event": "result",
+        "error": error,
+        "clicked_at": result.clicked_at,
+        "waits": result.waits,
+        "network": result.network,
+        "steps": steps,
+        "waited": gate.waited,
+        "metrics": metrics.export(),
+    })
+    return 0
 
-def morning_task_sync() -> None:
-    """Wrapper síncrono para la tarea de la mañana - Ejecuta en el loop global"""
-    if bot_state["running"] and event_loop:
-        # Usar ensure_future en lugar de asyncio.run()
-        asyncio.run_coroutine_threadsafe(morning_task(), event_loop)
-    else:
-        logger.warning("⏸️ Tarea de mañana saltada - Bot pausado")
 
-async def morning_task() -> None:
-    """Tarea de las 9:00 - Login y click en botón"""
-    async with async_playwright() as p:
+async def run_for_accounts(action: str, accounts: list, scheduled_at: float = None, two_phase: bool = False,
+                           trigger: str = "schedule") -> list:
+    """Ejecuta una acción sobre varias cuentas con concurrencia limitada y arranques escalonados.
+
+    scheduled_at es el epoch de la hora programada. En modo dos fases la
+    preparación empieza con la antelación que marca lead_estimator y el clic
+    espera a scheduled_at; si no, se ejecuta todo en el acto y scheduled_at
+    solo sirve para medir el retraso del clic. Cada cuenta queda en el
+    registro de fichajes con su origen (trigger) en cuanto termina, y como
+    fallida si el job se aborta antes.
+    """
+    semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENCY))
+    two_phase = two_phase and scheduled_at is not None
+    
+    if two_phase:
+        lead = lead_estimator.lead(action)
+        metrics.set("bixpe_preclick_lead_seconds", lead, {"action": action})
+        if scheduled_at - lead > time.time():
+            logger.info(f"⏳ Preparación de '{action}' {lead:.0f}s antes de la hora")
+            await sleep_until(scheduled_at - lead)
+    
+    async def run_one(index: int, account: Account) -> tuple:
+        # Cada cuenta corre en su propia tarea: los pasos medidos aquí son solo suyos
+        steps = {}
+        _run_steps.set(steps)
+        started_at = time.time()
+        run_id = uuid.uuid4().hex[:12]
         try:
-            logger.info("=" * 50)
-            logger.info("🌅 INICIANDO TAREA DE MAÑANA (9:00)")
-            logger.info("=" * 50)
-            await send_telegram_notification("🌅 Iniciando tarea de MAÑANA (9:00) - Login y fichaje")
-            
-            # Lanzar navegador
-            logger.info("🚀 Lanzando navegador Chrome...")
-            browser = await p.chromium.launch(headless=HEADLESS)
-            context = await browser.new_context()
-            page = await context.new_page()
-            
-            logger.info("🌐 Navegando a la página de login...")
-            await page.goto(LOGIN_URL, wait_until="networkidle")
-            
-            # Hacer login
-            logger.info("🔐 Ingresando credenciales...")
-            await page.fill("input#Username", USERNAME)
-            await page.fill("input#Password", PASSWORD)
-            
-            # Esperar y hacer clic en el botón de login
-            logger.info("🔘 Haciendo clic en botón de login...")
-            await page.click("button[type='submit']")
-            await page.wait_for_load_state("networkidle")
-            await asyncio.sleep(2)
-            
-            logger.info("✅ Login completado")
-            
-            # Enviar captura tras login
-            await take_screenshot_and_send(page, "✅ Login Exitoso - TAREA MAÑANA (9:00)")
-            
-            # Esperar antes de hacer clic en el siguiente botón
-            logger.info("⏳ Esperando 3 segundos antes de hacer clic en el botón de START...")
-            await asyncio.sleep(3)
-            
-            # Buscar y hacer clic en el botón de inicio
-            logger.info("🔍 Buscando botón de START...")
-            start_button = await page.query_selector("button#btn-start-workday")
-            if start_button:
-                await start_button.click()
-                logger.info("▶️ Botón START clickeado")
-                await asyncio.sleep(2)
-                
-                # Esperar a que aparezca el popup de confirmación
-                logger.info("⏳ Esperando popup de confirmación...")
-                try:
-                    confirm_button = await page.wait_for_selector("button.swal2-confirm.swal2-styled", timeout=5000)
-                    await confirm_button.click()
-                    logger.info("✅ Popup confirmado - Inicio de jornada confirmado")
-                    await asyncio.sleep(2)
-                except:
-                    logger.warning("⚠️ Popup no encontrado, continuando...")
-                
-                await take_screenshot_and_send(page, "▶️ Botón START y confirmación completados (9:00)")
-            else:
-                logger.warning("⚠️ Botón START no encontrado")
-            
-            await browser.close()
-            logger.info("🏁 TAREA DE MAÑANA COMPLETADA\n")
-            await send_telegram_notification("✅ Tarea de MAÑANA completada exitosamente", is_error=False)
-            
-        except Exception as e:
-            logger.error(f"❌ Error en tarea de mañana: {e}", exc_info=True)
-            await send_telegram_notification(f"<b>❌ ERROR en tarea MAÑANA:</b>\n<code>{str(e)}</code>", is_error=True)
-
-def afternoon_task_sync() -> None:
-    """Wrapper síncrono para la tarea de la tarde - Ejecuta en el loop global"""
-    if bot_state["running"] and event_loop:
-        # Usar ensure_future en lugar de asyncio.run()
-        asyncio.run_coroutine_threadsafe(afternoon_task(), event_loop)
-    else:
-        logger.warning("⏸️ Tarea de tarde saltada - Bot pausado")
+            # Escalonar los arranques para no saturar auth2.bixpe.com
+            await asyncio.sleep(index * STAGGER_SECONDS)
+            gate = ClickGate(scheduled_at if two_phase else None, semaphore, CLICK_JITTER_SECONDS)
+            with log_context(run_id=run_id, account=account.name, action=action):
+                result = await clock_task(account, action, gate)
+                logger.debug(
+                    f"🧾 Resultado: {'ok' if result.ok else 'error'} ({result.engine or '-'}, {result.duration:.2f}s)",
+                    extra={"step": "task", "duration": round(result.duration, 4)}
+                )
+        except asyncio.CancelledError:
+            # Job abortado (presupuesto agotado o /cancel): la cuenta queda registrada como fallida
+            result = RunResult(account=account.name, action=action, error="abortado antes de terminar",
+                               duration=time.time() - started_at, started_at=started_at, run_id=run_id, steps=steps)
+            await asyncio.shield(ledger.record(result, scheduled_at, trigger))
+            raise
+        result.started_at, result.steps, result.run_id = started_at, steps, run_id
+        # Se registra en cuanto termina, sin esperar al resto del grupo
+        record_run_metrics(result, scheduled_at)
+        await asyncio.shield(ledger.record(result, scheduled_at, trigger))
+        return result, gate
+    
+    started = time.perf_counter()
+    prepare_started = time.time()
+    outcomes = await asyncio.gather(*(run_one(i, a) for i, a in enumerate(accounts)))
+    results = [result for result, _ in outcomes]
+    
+    # Aprender cuánto tarda la preparación de todo el grupo para ajustar la antelación
+    prepared = [gate.prepared_at for _, gate in outcomes if gate.prepared_at]
+    if two_phase and prepared:
+        lead_estimator.record(action, max(prepared) - prepare_started)
+    
+    if len(accounts) > 1:
+        ok = sum(1 for r in results if r.ok)
+        lines = [
+            f"{'✅' if r.ok else '❌'} {r.account} ({r.engine or '-'}, {r.duration:.1f}s"
+            + (f", clic {r.click_error:+.2f}s" if r.click_error is not None else "") + ")"
+            + (f": <code>{html.escape(r.error)}</code>" if r.error else "")
+            for r in results
+        ]
+        await send_telegram_notification(
+            f"📊 <b>Resumen '{action}'</b>: {ok}/{len(results)} correctas en {time.perf_counter() - started:.1f}s\n\n"
+            + "\n".join(lines),
+            is_error=ok < len(results)
+        )
+    return results
 
 
-async def afternoon_task() -> None:
-    """Tarea de las 18:00 - Login y click en botón de stop"""
-    async with async_playwright() as p:
-        try:
-            logger.info("=" * 50)
-            logger.info("🌆 INICIANDO TAREA DE TARDE (18:00)")
-            logger.info("=" * 50)
-            await send_telegram_notification("🌆 Iniciando tarea de TARDE (18:00) - Finalizar jornada")
-            
-            # Lanzar navegador
-            logger.info("🚀 Lanzando navegador Chrome...")
-            browser = await p.chromium.launch(headless=HEADLESS)
-            context = await browser.new_context()
-            page = await context.new_page()
-            
-            logger.info("🌐 Navegando a la página de login...")
-            await page.goto(LOGIN_URL, wait_until="networkidle")
-            
-            # Hacer login
-            logger.info("🔐 Ingresando credenciales...")
-            await page.fill("input#Username", USERNAME)
-            await page.fill("input#Password", PASSWORD)
-            
-            # Esperar y hacer clic en el botón de login
-            logger.info("🔘 Haciendo clic en botón de login...")
-            await page.click("button[type='submit']")
-            await page.wait_for_load_state("networkidle")
-            await asyncio.sleep(2)
-            
-            logger.info("✅ Login completado")
-            
-            # Enviar captura tras login
-            await take_screenshot_and_send(page, "✅ Login Exitoso - TAREA TARDE (18:00)")
-            
-            # Esperar antes de hacer clic
-            logger.info("⏳ Esperando 3 segundos antes de hacer clic en el botón de STOP...")
-            await asyncio.sleep(3)
-            
-            # Buscar y hacer clic en el botón de stop
-            logger.info("🔍 Buscando botón de STOP...")
-            stop_button = await page.query_selector("button#btn-stop-workday")
-            if stop_button:
-                await stop_button.click()
-                logger.info("⏹️ Botón STOP clickeado")
-                await asyncio.sleep(2)
-                
-                # Esperar a que aparezca el popup de confirmación
-                logger.info("⏳ Esperando popup de confirmación...")
-                try:
-                    confirm_button = await page.wait_for_selector("button.swal2-confirm.swal2-styled", timeout=5000)
-                    await confirm_button.click()
-                    logger.info("✅ Popup confirmado - 'Sí, finalizar mi jornada' clickeado")
-                    await asyncio.sleep(2)
-                except Exception:
-                    logger.warning("⚠️ Popup no encontrado, continuando...")
-                
-                await take_screenshot_and_send(page, "⏹️ Botón STOP y confirmación completados (18:00)")
-            else:
-                logger.warning("⚠️ Botón STOP no encontrado")
-            
-            await browser.close()
-            logger.info("🏁 TAREA DE TARDE COMPLETADA\n")
-            await send_telegram_notification("✅ Tarea de TARDE completada exitosamente", is_error=False)
-            
-        except Exception as e:
-            logger.error(f"❌ Error en tarea de tarde: {e}", exc_info=True)
-            await send_telegram_notification(f"<b>❌ ERROR en tarea TARDE:</b>\n<code>{str(e)}</code>", is_error=True)
+async def prewarm_job() -> None:
+    """Precalienta el navegador antes de cada fichaje (salvo si hoy no trabaja ninguna cuenta)"""
+    day = ledger_day()
+    if all(work_calendar.day_off(account.name, day) for account in roster):
+        return
+    if bot_state["running"] and not shutdown_event.is_set():
+        await browser_manager.prewarm()
 
 
-def shutdown_scheduler(signum, frame) -> None:
-    """Maneja el cierre graceful del scheduler"""
-    logger.info("\n🛑 Señal de cierre recibida...")
-    if scheduler and scheduler.running:
-        scheduler.shutdown()
-        logger.info("✅ Scheduler detenido")
-    sys.exit(0)
+def request_shutdown(signum: int) -> None:
+    """Manejador de SIGINT/SIGTERM: solo marca el cierre, main() se encarga del resto"""
+    logger.info(f"\n🛑 Señal {signal.Signals(signum).name} recibida, cerrando...")
+    shutdown_event.set()
+
+
+def schedule_groups() -> dict:
+    """Agrupa las cuentas por (acción, hora, días) para crear un job por grupo"""
+    groups = {}
+    for account in roster:
+        for action in WORKDAY_ACTIONS:
+            at = account_time(account, action)
+            if at:
+                groups.setdefault((action, at, account.days), []).append(account.name)
+    return groups
+
+
+# Días de la expresión cron en español (mon-fri -> L-V)
+_DAY_LABELS = {"mon": "L", "tue": "M", "wed": "X", "thu": "J", "fri": "V", "sat": "S", "sun": "D"}
+
+
+def schedule_summary() -> str:
+    """Tareas programadas (según schedule_groups) para los mensajes de Telegram"""
+    lines = []
+    for (action, at, days), names in sorted(schedule_groups().items(), key=lambda item: (item[0][1], item[0][2])):
+        spec = WORKDAY_ACTIONS[action]
+        label = days.lower()
+        for day, short in _DAY_LABELS.items():
+            label = label.replace(day, short)
+        who = f" - {len(names)} cuenta(s)" if len(roster) > 1 else ""
+        lines.append(f"• {at} ({label}) - {spec['summary'] or spec['label'].capitalize()}{who}")
+    return "\n".join(lines) or "• Ninguna"
 
 
 def init_scheduler() -> None:
@@ -359,33 +3177,69 @@ def init_scheduler() -> None:
     
     # Usar AsyncIOScheduler en lugar de BackgroundScheduler
     scheduler = AsyncIOScheduler()
-    tz = pytz.timezone('Europe/Madrid')
+    tz = TIMEZONE
     
-    # Programar tarea de mañana a las 9:00
-    scheduler.add_job(
-        morning_task_sync,
-        CronTrigger(day_of_week='mon-fri', hour=9, minute=0, second=0, timezone=tz),
-        id='morning_task',
-        name='Tarea Mañana (9:00, L-V)',
-        replace_existing=True,
-        misfire_grace_time=60
-    )
+    labels = {action: f"Tarea {spec['label'].capitalize()}" for action, spec in WORKDAY_ACTIONS.items()}
+    prewarm_times = set()
+    logger.info("📅 Tareas programadas:")
+    
+    # Un job por grupo de cuentas con la misma acción, hora y días
+    for (action, at, days), names in sorted(schedule_groups().items()):
+        hour, minute = (int(part) for part in at.split(":"))
+        # En modo dos fases el job se dispara PRECLICK_MAX_LEAD antes y espera dentro a la hora exacta
+        fire_at = datetime(2000, 1, 1, hour, minute)
+        if TWO_PHASE_SCHEDULING:
+            fire_at = max(fire_at - timedelta(seconds=PRECLICK_MAX_LEAD), datetime(2000, 1, 1))
+        scheduler.add_job(
+            clock_job,
+            CronTrigger(day_of_week=days, hour=fire_at.hour, minute=fire_at.minute, second=fire_at.second, timezone=tz),
+            args=[action, names, at],
+            id=f'{action}_{hour:02d}{minute:02d}_{days}',
+            name=f'{labels[action]} ({at}, {days})',
+            replace_existing=True,
+            misfire_grace_time=60,
+            max_instances=1,
+            coalesce=True
+        )
+        prewarm_times.add((hour, minute, days))
+        logger.info(f"   • {at} ({days}) - {labels[action]}: {len(names)} cuenta(s)")
+    
+    # Precalentar el navegador unos minutos antes de cada fichaje (no aplica si cada acción lanza el suyo)
+    if BROWSER_PREWARM_MINUTES > 0 and not BROWSER_WORKER:
+        for hour, minute, days in sorted(prewarm_times):
+            prewarm_at = datetime(2000, 1, 1, hour, minute) - timedelta(minutes=BROWSER_PREWARM_MINUTES)
+            scheduler.add_job(
+                prewarm_job,
+                CronTrigger(day_of_week=days, hour=prewarm_at.hour, minute=prewarm_at.minute, second=0, timezone=tz),
+                id=f'prewarm_{prewarm_at.strftime("%H%M")}_{days}',
+                name=f'Precalentar navegador ({prewarm_at.strftime("%H:%M")}, {days})',
+                replace_existing=True,
+                misfire_grace_time=60,
+                max_instances=1,
+                coalesce=True
+            )
+        logger.info(f"🔥 Precalentamiento del navegador {BROWSER_PREWARM_MINUTES} min antes de cada tarea")
     
-    # Programar tarea de tarde a las 18:00
+    # Latido para /healthz; si se pierde (p. ej. tras una pausa) se ejecuta en cuanto se pueda
     scheduler.add_job(
-        afternoon_task_sync,
-        CronTrigger(day_of_week='mon-fri', hour=18, minute=0, second=0, timezone=tz),
-        id='afternoon_task',
-        name='Tarea Tarde (18:00, L-V)',
+        scheduler_heartbeat,
+        IntervalTrigger(seconds=SCHEDULER_TICK_SECONDS),
+        id='heartbeat',
+        name='Latido del scheduler',
         replace_existing=True,
-        misfire_grace_time=60
+        next_run_time=datetime.now(tz),
+        misfire_grace_time=None,
+        max_instances=1,
+        coalesce=True
     )
     
     # scheduler.start()  <-- Se elimina de aquí, se inicia en main
     logger.info("✅ Scheduler configurado correctamente")
-    logger.info("📅 Tareas programadas (Lunes a Viernes):")
-    logger.info("   • 09:00 - Tarea de MAÑANA (Login + Fichaje)")
-    logger.info("   • 18:00 - Tarea de TARDE (Stop + Finalizar jornada)")
+
+
+async def note_telegram_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Marca Telegram como disponible al recibir una actualización (no responde a nada)"""
+    watchdog.telegram_seen(True)
 
 
 async def init_telegram_handlers():
@@ -394,12 +3248,17 @@ async def init_telegram_handlers():
         logger.warning("⚠️ TELEGRAM_TOKEN no configurado - Comandos deshabilitados")
         return None
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    app = Application.builder().token(TELEGRAM_TOKEN).base_url(TELEGRAM_API_URL).build()
     
     # Agregar handlers de comandos
     app.add_handler(CommandHandler("start", handle_start_command))
     app.add_handler(CommandHandler("stop", handle_stop_command))
     app.add_handler(CommandHandler("status", handle_status_command))
+    app.add_handler(CommandHandler("cancel", handle_cancel_command))
+    app.add_handler(CommandHandler("history", handle_history_command))
+    app.add_handler(CommandHandler("vacation", handle_vacation_command))
+    # Cualquier actualización recibida (webhook o polling) prueba que Telegram responde
+    app.add_handler(TypeHandler(Update, note_telegram_update), group=-1)
     
     bot_state["app"] = app
     
@@ -408,26 +3267,304 @@ async def init_telegram_handlers():
     logger.info("   • /start - Reanudar bot")
     logger.info("   • /stop - Pausar bot")
     logger.info("   • /status - Ver estado")
+    logger.info("   • /cancel - Cancelar fichajes en curso")
+    logger.info("   • /history - Últimos fichajes")
+    logger.info("   • /vacation - Festivos y vacaciones")
     
     return app
 
 
+class HealthWatchdog:
+    """Vigila que el bot siga vivo: retraso del loop, latido del scheduler, Telegram y navegador.
+
+    Una corrutina mide cada WATCHDOG_INTERVAL cuánto se retrasa su propio
+    despertar y, si supera LOOP_LAG_THRESHOLD, vuelca las pilas de todas las
+    tareas. Un loop bloqueado no puede avisar de sí mismo, así que un hilo
+    aparte vigila ese latido: vuelca la pila del hilo del loop mientras sigue
+    bloqueado y, tras LOOP_STALL_EXIT segundos, termina el proceso para que
+    Docker reinicie el contenedor. El estado de Telegram sale de los envíos
+    del outbox y de las actualizaciones recibidas; solo si no hay tráfico en
+    TELEGRAM_PROBE_INTERVAL se comprueba con getMe.
+    """
+
+    def __init__(self, interval: float, lag_threshold: float, stall_exit: float,
+                 tick_interval: float, probe_interval: float):
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.stall_exit = stall_exit
+        self.tick_interval = tick_interval
+        self.probe_interval = probe_interval
+        self.lag = 0.0
+        self._recent_lags = deque(maxlen=max(1, int(60 / interval)))  # Último minuto
+        self.last_beat = time.monotonic()
+        self.last_tick = None  # time.time() del último latido del scheduler
+        self.telegram = {"ok": None, "checked_at": None, "error": ""}
+        self._telegram_seen_at = float("-inf")  # time.monotonic() del último tráfico con Telegram
+        self._task = None
+        self._probe = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+        self._stalled = False
+
+    def start(self) -> None:
+        """Arranca la corrutina en el loop actual y el hilo vigilante"""
+        self._loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run(), name="watchdog")
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        for task in (self._task, self._probe):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._probe = None
+
+    def tick(self) -> None:
+        """Latido del scheduler (lo llama un job periódico)"""
+        self.last_tick = time.time()
+
+    def telegram_seen(self, ok: bool, error: str = "") -> None:
+        """Resultado de una llamada real a Telegram (envío, actualización recibida o getMe)"""
+        if ok and self.telegram["ok"] is False:
+            logger.info("📶 Conexión con Telegram recuperada")
+        elif not ok and self.telegram["ok"] is not False:
+            logger.warning(f"⚠️ Sin conexión con Telegram: {error}")
+        self.telegram = {"ok": ok, "checked_at": time.time(), "error": error}
+        self._telegram_seen_at = time.monotonic()
+        metrics.set("bixpe_telegram_up", int(ok))
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - expected)
+            self._recent_lags.append(self.lag)
+            self.last_beat = time.monotonic()
+            metrics.set("bixpe_event_loop_lag_seconds", self.lag)
+            if self.lag >= self.lag_threshold:
+                metrics.inc("bixpe_event_loop_stalls_total")
+                logger.warning(f"🐢 Loop retrasado {self.lag:.2f}s - pilas de las tareas:\n{self.dump_tasks()}")
+            # Con tráfico reciente ya se sabe si Telegram responde: getMe solo tras un rato en silencio
+            idle = time.monotonic() - self._telegram_seen_at >= self.probe_interval
+            if telegram_bot is not None and idle and (self._probe is None or self._probe.done()):
+                self._probe = asyncio.create_task(self._probe_telegram(telegram_bot), name="telegram-probe")
+
+    @staticmethod
+    def dump_tasks() -> str:
+        """Pila de cada tarea viva del loop (salvo la que llama)"""
+        current = asyncio.current_task()
+        stacks = []
+        for task in asyncio.all_tasks():
+            if task is current:
+                continue
+            buffer = io.StringIO()
+            task.print_stack(limit=10, file=buffer)
+            stacks.append(buffer.getvalue())
+        return "\n".join(stacks)
+
+    async def _probe_telegram(self, bot) -> None:
+        """Comprueba la conexión con la API de Telegram (getMe)"""
+        try:
+            await asyncio.wait_for(bot.get_me(), 10)
+            self.telegram_seen(True)
+        except Exception as e:
+            self.telegram_seen(False, str(e) or type(e).__name__)
+
+    def _monitor(self) -> None:
+        """Hilo vigilante: detecta el loop bloqueado mientras lo está"""
+        while not self._stopped.wait(self.interval):
+            blocked = time.monotonic() - self.last_beat - self.interval
+            if blocked < self.lag_threshold:
+                self._stalled = False
+                continue
+            if not self._stalled:
+                self._stalled = True
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no disponible)"
+                logger.error(f"🧊 El loop lleva {blocked:.1f}s sin responder - pila del hilo del loop:\n{stack}")
+            if self.stall_exit > 0 and blocked >= self.stall_exit:
+                logger.critical(f"💀 Loop bloqueado {blocked:.0f}s - saliendo para que Docker reinicie el contenedor")
+                if log_listener is not None:
+                    log_listener.stop()
+                os._exit(70)
+
+    def health(self) -> dict:
+        """Estado de cada comprobación y veredicto global: ok, degraded o fail"""
+        now = time.time()
+        failed, degraded = [], []
+
+        loop_check = {
+            "lag": round(self.lag, 3),
+            "max_lag_1m": round(max(self._recent_lags, default=0.0), 3),
+            "threshold": self.lag_threshold,
+        }
+        if self.lag >= self.lag_threshold:
+            failed.append("loop")
+
+        if scheduler is None or scheduler.state == STATE_STOPPED:
+            scheduler_check = {"state": "stopped"}
+            failed.append("scheduler")
+        else:
+            tick_age = round(now - self.last_tick, 1) if self.last_tick else None
+            paused = scheduler.state == STATE_PAUSED
+            scheduler_check = {"state": "paused" if paused else "running", "tick_age": tick_age}
+            # Pausado con /stop no hay latidos, y no es un fallo
+            if not paused and (tick_age is None or tick_age > 3 * self.tick_interval):
+                failed.append("scheduler")
+
+        if not TELEGRAM_TOKEN:
+            telegram_check = {"state": "disabled"}
+        else:
+            telegram_check = {
+                "state": {True: "ok", False: "error", None: "unknown"}[self.telegram["ok"]],
+                "checked_at": self.telegram["checked_at"],
+                "pending": len(outbox),
+            }
+            if self.telegram["error"]:
+                telegram_check["error"] = self.telegram["error"]
+            # Reiniciar el contenedor no arregla una caída de Telegram: solo degradado
+            if self.telegram["ok"] is False:
+                degraded.append("telegram")
+
+        browser_check = browser_manager.state()
+        if browser_check["state"] == "disconnected":
+            degraded.append("browser")
+
+        status = "fail" if failed else "degraded" if degraded else "ok"
+        return {
+            "status": status,
+            "failed": failed,
+            "degraded": degraded,
+            "inflight": len(inflight),
+            "checks": {"loop": loop_check, "scheduler": scheduler_check, "telegram": telegram_check, "browser": browser_check},
+        }
+
+
+# Vigilancia del loop, expuesta en /healthz
+watchdog = HealthWatchdog(WATCHDOG_INTERVAL, LOOP_LAG_THRESHOLD, LOOP_STALL_EXIT, SCHEDULER_TICK_SECONDS, TELEGRAM_PROBE_INTERVAL)
+
+
+async def scheduler_heartbeat() -> None:
+    """Job periódico: demuestra que el scheduler sigue despachando en el loop"""
+    watchdog.tick()
+
+
+class _HeartbeatLogFilter(logging.Filter):
+    """Evita que APScheduler llene el log con cada ejecución del latido"""
+
+    def filter(self, record) -> bool:
+        return not (record.args and getattr(record.args[0], "id", None) == "heartbeat")
+
+
+logging.getLogger("apscheduler.executors.default").addFilter(_HeartbeatLogFilter())
+
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    """Estado de salud para el HEALTHCHECK de Docker (503 si algo ha fallado)"""
+    health = watchdog.health()
+    return web.json_response(health, status=503 if health["status"] == "fail" else 200)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """Expone las métricas en formato de texto de Prometheus"""
+    metrics.set("bixpe_browser_rss_bytes", await asyncio.to_thread(_child_processes_rss))
+    metrics.set("bixpe_process_rss_bytes", _read_rss("self"))
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+def webhook_enabled() -> bool:
+    """Indica si las actualizaciones de Telegram llegan por webhook en lugar de polling"""
+    return bool(TELEGRAM_TOKEN and TELEGRAM_WEBHOOK_URL and SERVER_PORT > 0)
+
+
+async def handle_telegram_webhook(request: web.Request) -> web.Response:
+    """Recibe una actualización de Telegram y la pasa a la Application"""
+    # Telegram repite en cada petición el secret_token registrado con set_webhook
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET):
+        logger.warning(f"⚠️ Petición al webhook rechazada desde {request.remote}")
+        return web.Response(status=403)
+    app = bot_state["app"]
+    if app is None:
+        return web.Response(status=503)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    await app.update_queue.put(Update.de_json(data, app.bot))
+    return web.Response()
+
+
+async def start_http_server():
+    """Arranca el servidor HTTP interno en el loop actual (None si está desactivado)"""
+    if SERVER_PORT <= 0:
+        return None
+    
+    http_app = web.Application()
+    http_app.router.add_get("/metrics", handle_metrics)
+    http_app.router.add_get("/healthz", handle_healthz)
+    if webhook_enabled():
+        http_app.router.add_post(urlparse(TELEGRAM_WEBHOOK_URL).path or "/", handle_telegram_webhook)
+    
+    runner = web.AppRunner(http_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, SERVER_HOST, SERVER_PORT).start()
+    logger.info(f"📈 Métricas disponibles en http://{SERVER_HOST}:{SERVER_PORT}/metrics (salud en /healthz)")
+    if webhook_enabled():
+        logger.info(f"📨 Webhook de Telegram escuchando en {urlparse(TELEGRAM_WEBHOOK_URL).path or '/'}")
+    return runner
+
+
 async def main() -> None:
     """Función principal - mantiene el bot corriendo 24/7"""
-    global event_loop
-    event_loop = asyncio.get_event_loop()
-    
+    global log_listener
+    log_listener = setup_logging()
     logger.info("\n" + "🤖 " * 20)
     logger.info("INICIALIZANDO BOT DE BIXPE - MODO 24/7 CON TELEGRAM")
     logger.info("🤖 " * 20 + "\n")
     
-    logger.info(f"📌 Usuario: {USERNAME}")
+    global roster
+    extra_actions = load_actions()
+    if extra_actions:
+        logger.info(f"🧩 Acciones de ACTIONS_FILE: {', '.join(extra_actions)}")
+    roster = load_accounts()
+    if len(roster) == 1:
+        logger.info(f"📌 Usuario: {roster[0].username}")
+    else:
+        logger.info(f"👥 Cuentas: {len(roster)} (concurrencia máx. {MAX_CONCURRENCY}, escalonado {STAGGER_SECONDS}s)")
     logger.info(f"🔗 URL: {LOGIN_URL}")
     logger.info(f"👁️ Headless: {HEADLESS}\n")
     
-    # Registrar manejadores de señales para cierre graceful
-    signal.signal(signal.SIGINT, shutdown_scheduler)
-    signal.signal(signal.SIGTERM, shutdown_scheduler)
+    # Registrar manejadores de señales para cierre graceful (en el loop, sin interrumpir tareas)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, request_shutdown, signum)
+    
+    # Registro de fichajes: saber qué se hizo ya hoy antes de programar nada
+    try:
+        done = await ledger.load()
+        logger.info(f"📒 Registro de fichajes: {LEDGER_PATH} ({done} acciones correctas recientes)")
+    except Exception as e:
+        logger.error(f"❌ No se pudo abrir el registro de fichajes ({e}) - sin control de duplicados")
+    
+    # Calendario laboral: festivos y vacaciones que el scheduler consulta antes de cada job
+    try:
+        days_off = work_calendar.load(roster)
+        logger.info(f"📅 Calendario laboral: {days_off} día(s) libre(s) entre todas las cuentas en el próximo año")
+    except Exception as e:
+        logger.error(f"❌ No se pudo cargar el calendario laboral ({e}) - se fichará todos los días programados")
     
     # Inicializar scheduler (configuración de jobs)
     init_scheduler()
@@ -440,49 +3577,82 @@ async def main() -> None:
     if app:
         global telegram_bot
         telegram_bot = app.bot
+        restored = outbox.load()
+        if restored:
+            logger.info(f"📬 {restored} envíos de Telegram pendientes recuperados")
+        outbox.start(app.bot)
 
     # Iniciar el scheduler explícitamente dentro del loop principal
     if scheduler and not scheduler.running:
         scheduler.start()
         logger.info("✅ Scheduler iniciado")
+
+    # Servidor HTTP interno (/metrics, /healthz) en el mismo loop
+    watchdog.start()
+    http_runner = await start_http_server()
     
     try:
-        await send_telegram_notification("🤖 <b>Bot iniciado - Modo 24/7 activado</b>\n\n📅 Próximas tareas (Lunes a Viernes):\n• 09:00 - Login + Fichaje\n• 18:00 - Finalizar jornada\n\n📱 Usa: /start /stop /status")
+        await send_telegram_notification(f"🤖 <b>Bot iniciado - Modo 24/7 activado</b>\n\n📅 Tareas programadas:\n{schedule_summary()}\n\n📱 Usa: /start /stop /status /cancel /history /vacation")
         logger.info("🌐 Bot en modo 24/7, esperando próxima tarea...\n")
         
-        # Iniciar polling de Telegram si está configurado
+        # Recibir comandos de Telegram: webhook si hay URL pública, si no long polling
         if app:
-            logger.info("📱 Iniciando polling de Telegram...")
             await app.initialize()
             await app.start()
-            await app.updater.start_polling()
-            logger.info("✅ Polling de Telegram iniciado\n")
+            if webhook_enabled():
+                await app.bot.set_webhook(TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_WEBHOOK_SECRET)
+                logger.info(f"✅ Webhook de Telegram registrado en {TELEGRAM_WEBHOOK_URL}\n")
+            else:
+                if TELEGRAM_WEBHOOK_URL:
+                    logger.warning("⚠️ TELEGRAM_WEBHOOK_URL requiere SERVER_PORT > 0 - usando polling")
+                logger.info("📱 Iniciando polling de Telegram...")
+                await app.updater.start_polling()
+                logger.info("✅ Polling de Telegram iniciado\n")
         
-        # Mantener el bot corriendo indefinidamente
-        while True:
-            await asyncio.sleep(60)
+        # Recuperar las acciones de hoy que se perdieron mientras el bot estaba parado
+        if CATCHUP_ON_START:
+            await catch_up()
+        
+        # Mantener el bot corriendo hasta recibir la señal de cierre
+        await shutdown_event.wait()
+        logger.info("🛑 Cerrando bot...")
             
-    except KeyboardInterrupt:
-        logger.info("\n🛑 Bot detenido por el usuario")
-        if app:
-            await app.updater.stop()
-            await app.stop()
-            await app.shutdown()
-        if scheduler and scheduler.running:
-            scheduler.shutdown()
     except Exception as e:
         logger.error(f"\n❌ Error fatal: {e}", exc_info=True)
-        await send_telegram_notification(f"<b>❌ ERROR FATAL EN BOT:</b>\n<code>{str(e)}</code>", is_error=True)
-        if app:
-            try:
+        await send_telegram_notification(f"<b>❌ ERROR FATAL EN BOT:</b>\n<code>{html.escape(str(e))}</code>", is_error=True)
+    finally:
+        await shutdown(app, http_runner)
+
+
+async def shutdown(app, http_runner) -> None:
+    """Cierre ordenado: sin jobs nuevos, esperar a los fichajes en curso y liberar recursos"""
+    # Pausar antes de apagar: shutdown() del scheduler cancelaría los jobs en curso
+    if scheduler and scheduler.running:
+        scheduler.pause()
+    await drain_inflight(SHUTDOWN_GRACE)
+    if scheduler and scheduler.running:
+        scheduler.shutdown(wait=False)
+        logger.info("✅ Scheduler detenido")
+    if app:
+        try:
+            if app.updater.running:
                 await app.updater.stop()
+            if app.running:
                 await app.stop()
-                await app.shutdown()
-            except Exception:
-                pass
-        if scheduler and scheduler.running:
-            scheduler.shutdown()
+            await app.shutdown()
+        except Exception as e:
+            logger.warning(f"⚠️ Error al detener Telegram: {e}")
+    await outbox.stop()
+    await browser_manager.close()
+    await close_http_pool()
+    await ledger.close()
+    if http_runner:
+        await http_runner.cleanup()
+    await watchdog.stop()
+    logger.info("👋 Bot detenido")
 
 
 if __name__ == "__main__":
+    if "--browser-worker" in sys.argv[1:]:
+        sys.exit(asyncio.run(browser_worker_main()))
     asyncio.run(main())
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Los tests importan main.py desde la raíz del repositorio, con datos en un directorio temporal
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bixpe-tests-"))
@@ -0,0 +1,102 @@
+"""Tests del análisis de festivos: fechas de /vacation y calendarios ICS"""
+import asyncio
+from datetime import date, datetime
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+RANGE = (date(2025, 1, 1), date(2028, 12, 31))
+
+
+def ics(*events: str) -> str:
+    """Calendario ICS con CRLF, como los que exportan Google Calendar u Outlook"""
+    body = "".join(f"BEGIN:VEVENT\r\n{event.strip()}\r\nEND:VEVENT\r\n" for event in events)
+    return f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n{body}END:VCALENDAR\r\n"
+
+
+class _Datetime2028(datetime):
+    """datetime con "ahora" en un año bisiesto"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2028, 3, 1, tzinfo=tz)
+
+
+def test_parse_day_formats():
+    assert main._parse_day("2026-08-03") == date(2026, 8, 3)
+    assert main._parse_day(" 03/08/2026 ") == date(2026, 8, 3)
+    assert main._parse_day("03/08") == date(datetime.now(main.TIMEZONE).year, 8, 3)
+    with pytest.raises(ValueError):
+        main._parse_day("2026-13-01")
+
+
+def test_parse_day_leap_day_without_year(monkeypatch):
+    monkeypatch.setattr(main, "datetime", _Datetime2028)
+    assert main._parse_day("29/02") == date(2028, 2, 29)
+
+
+def test_all_day_event_end_is_exclusive():
+    text = ics("DTSTART;VALUE=DATE:20261012\r\nDTEND;VALUE=DATE:20261013\r\nSUMMARY:Fiesta Nacional")
+    assert main._parse_ics(text, *RANGE) == {"2026-10-12": "Fiesta Nacional"}
+
+
+def test_multi_day_event():
+    text = ics("DTSTART;VALUE=DATE:20261207\r\nDTEND;VALUE=DATE:20261210\r\nSUMMARY:Puente")
+    assert main._parse_ics(text, *RANGE) == {"2026-12-07": "Puente", "2026-12-08": "Puente", "2026-12-09": "Puente"}
+
+
+def test_multi_day_event_is_clipped_to_range():
+    text = ics("DTSTART;VALUE=DATE:20241230\r\nDTEND;VALUE=DATE:20250103\r\nSUMMARY:Navidad")
+    assert sorted(main._parse_ics(text, *RANGE)) == ["2025-01-01", "2025-01-02"]
+
+
+def test_timed_events_do_not_mark_the_day_off():
+    text = ics(
+        "DTSTART:20261015T100000Z\r\nDTEND:20261015T110000Z\r\nSUMMARY:Reunión",
+        "DTSTART;TZID=Europe/Madrid:20261016T090000\r\nSUMMARY:Guardia",
+    )
+    assert main._parse_ics(text, *RANGE) == {}
+
+
+def test_yearly_with_count():
+    text = ics("DTSTART;VALUE=DATE:20250101\r\nRRULE:FREQ=YEARLY;COUNT=2\r\nSUMMARY:Año Nuevo")
+    assert sorted(main._parse_ics(text, *RANGE)) == ["2025-01-01", "2026-01-01"]
+
+
+def test_yearly_with_until():
+    text = ics("DTSTART;VALUE=DATE:20250501\r\nRRULE:FREQ=YEARLY;UNTIL=20270501T000000Z\r\nSUMMARY:Trabajo")
+    assert sorted(main._parse_ics(text, *RANGE)) == ["2025-05-01", "2026-05-01", "2027-05-01"]
+
+
+def test_yearly_without_limit_fills_the_range():
+    text = ics("DTSTART;VALUE=DATE:20201225\r\nDTEND;VALUE=DATE:20201226\r\nRRULE:FREQ=YEARLY\r\nSUMMARY:Navidad")
+    assert sorted(main._parse_ics(text, *RANGE)) == ["2025-12-25", "2026-12-25", "2027-12-25", "2028-12-25"]
+
+
+def test_folded_lines_and_escaped_commas():
+    text = ics("DTSTART;VALUE=DATE:20261208\r\nSUMMARY:Inmaculada Concepción\\, festivo\r\n  nacional")
+    assert main._parse_ics(text, *RANGE) == {"2026-12-08": "Inmaculada Concepción, festivo nacional"}
+
+
+def test_holiday_text_file(tmp_path):
+    path = tmp_path / "festivos.txt"
+    path.write_text("# Madrid\n2026-05-02 Comunidad de Madrid\n15/05/2026 San Isidro\n2029-01-01 Fuera de rango\n", encoding="utf-8")
+    assert main.load_holiday_file(str(path), *RANGE) == {"2026-05-02": "Comunidad de Madrid", "2026-05-15": "San Isidro"}
+
+
+def test_vacation_add_crossing_new_year(monkeypatch, tmp_path):
+    """/vacation add 24/12 06/01: el final sin año pasa al año siguiente"""
+
+    class Message:
+        async def reply_text(self, text, **kwargs):
+            pass
+
+    monkeypatch.setattr(main, "datetime", _Datetime2028)
+    monkeypatch.setattr(main, "TELEGRAM_CHAT_ID", "99")
+    monkeypatch.setattr(main, "roster", [main.Account("ana", "ana", "p", chat_id="11")])
+    monkeypatch.setattr(main, "work_calendar", main.WorkCalendar([], str(tmp_path / "vacations.json")))
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=11), message=Message())
+    asyncio.run(main.handle_vacation_command(update, SimpleNamespace(args=["add", "24/12", "06/01", "Navidad"])))
+    assert [(v["start"], v["end"], v["note"]) for v in main.work_calendar.vacations] == [("2028-12-24", "2029-01-06", "Navidad")]